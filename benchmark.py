@@ -0,0 +1,91 @@
+"""
+Compare the Voronoi and raster centerline engines on synthetic meandering channels of
+increasing length. This doesn't need any input data:
+
+    python benchmark.py
+    python benchmark.py --lengths 500 1000 2000 --density 0.5 --cellsize 0.5
+"""
+import argparse
+import time
+import numpy as np
+from shapely.geometry import *
+
+from rivertools.shapes import densifyShape, getRiverPoints, getBufferedBounds, projToShape, splitClockwise
+from rivertools.vor import NARVoronoi
+from rivertools.medialaxis import MedialAxisRaster
+
+
+def syntheticChannel(length, width=10.0, spacing=2.0):
+    """
+    A meandering channel with wobbly banks and a rough thalweg down the middle
+    :param length: Length of the reach along x
+    :param width: Approximate width of the channel
+    :param spacing: Vertex spacing of the raw banks
+    :return: (Polygon, LineString)
+    """
+    x = np.arange(0, length + spacing, spacing)
+    mid = 15 * np.sin(x / 30.0)
+    left = np.column_stack((x, mid + width / 2 + 1.5 * np.sin(x / 7.0)))
+    right = np.column_stack((x, mid - width / 2 - 1.0 * np.cos(x / 5.0)))
+    river = Polygon(np.concatenate((left, right[::-1])))
+    thalweg = LineString(np.column_stack((x[2:-2:10], mid[2:-2:10])))
+    return river, thalweg
+
+
+def voronoiEngine(river, thalweg, density):
+    """
+    The same steps centerline() takes for the Voronoi engine
+    :return: (centerline, number of points)
+    """
+    bounds = getBufferedBounds(river, 10)
+    thalweglist = list(thalweg.coords)
+    thalweglist.insert(0, projToShape(LineString([thalweg.coords[1], thalweg.coords[0]]), bounds).coords[1])
+    thalweglist.append(projToShape(LineString([thalweg.coords[-2], thalweg.coords[-1]]), bounds).coords[1])
+    bankshapes = splitClockwise(bounds, LineString(thalweglist))
+
+    points = getRiverPoints(densifyShape(river, density), bankshapes[0])
+    centerline = NARVoronoi(points).collectCenterLines(Polygon(river.exterior))
+    return centerline.intersection(river), len(points)
+
+
+def rasterEngine(river, thalweg, cellSize):
+    """
+    The same steps centerline() takes for the raster engine
+    :return: (centerline, number of cells)
+    """
+    medialAxis = MedialAxisRaster(river, cellSize)
+    centerline = medialAxis.centerline(thalweg.coords[0], thalweg.coords[-1])
+    return centerline, medialAxis.wet.size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lengths', type=float, nargs='+', default=[250, 500, 1000, 2000],
+                        help='Reach lengths (in m) to try')
+    parser.add_argument('--density', type=float, default=0.5, help='Voronoi point spacing (in m)')
+    parser.add_argument('--cellsize', type=float, default=0.5, help='Raster cell size (in m)')
+    args = parser.parse_args()
+
+    print("{0:>8} {1:>10} {2:>10} {3:>10} {4:>10} {5:>12}".format(
+        "Length", "Points", "Voronoi(s)", "Cells", "Raster(s)", "MedianDiff"))
+
+    for length in args.lengths:
+        river, thalweg = syntheticChannel(length)
+
+        tic = time.time()
+        vorLine, numPoints = voronoiEngine(river, thalweg, args.density)
+        vorTime = time.time() - tic
+
+        tic = time.time()
+        rasterLine, numCells = rasterEngine(river, thalweg, args.cellsize)
+        rasterTime = time.time() - tic
+
+        # How far the raster line strays from the Voronoi line
+        diff = np.median([vorLine.distance(Point(pt)) for pt in rasterLine.coords])
+
+        print("{0:>8.0f} {1:>10d} {2:>10.2f} {3:>10d} {4:>10.2f} {5:>12.3f}".format(
+            length, numPoints, vorTime, numCells, rasterTime, diff))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,13 @@
 import sys
+import multiprocessing
 from shapely.geometry import *
 import argparse
 from logger import Logger
 
 # We wrote two little files with helper methods:
 from vor import NARVoronoi
+from tiling import tiledCenterline
+from medialaxis import MedialAxisRaster
 from shapes import *
 from geosmoothing import *
 
@@ -12,8 +15,74 @@ from geosmoothing import *
 # Here are some factors you can play with
 # The factor to throw into shapely.simplify (http://toblerity.org/shapely/manual.html)
 SHAPELY_SIMPLIFY = 0.01
+# When --coarse is used: how much bend or width change along the coarse centerline we put up
+# with before we go back to dense points, and how much further than the nearest bank we look for them
+CORRIDOR_TOLERANCE = 0.25
 ########################################################
 
+# Shared state for alternateLine(). See centerline() for why this is a module global
+_ALTLINE_STATE = {}
+
+
+def alternateLine(idx):
+    """
+    Find, smooth and reconnect the side-channel line around one island. This runs either
+    serially or inside a worker process so it only reads from _ALTLINE_STATE
+    :param idx: The index of the island (interior) in the smoothed river shape
+    :return: LineString or None if there is no usable alternate line
+    """
+    log = Logger("Centerline")
+    state = _ALTLINE_STATE
+    centerlineSmooth = state['centerlineSmooth']
+
+    if state['diffLines'] is not None:
+        diffaltline = state['diffLines'].get(idx)
+        if diffaltline is None or diffaltline.type != "LineString":
+            log.warning("Could not find a single side-channel line around island {0}. Skipping.".format(idx))
+            return None
+    else:
+        altLine = state['vor'].collectCenterLines(state['boundary'], flipIsland=idx)
+        if altLine.type != "LineString":
+            return None
+        # We difference the alternate lines with the main line
+        # to get just the bit that is different
+        diffaltline = altLine.difference(centerlineSmooth)
+
+    log.info("  Spline Smoothing Alternate line...")
+    if (state['smoothing'] > 0):
+        # Now smooth this line to be roughly the consistency of skippy peanut butter
+        linespliner = GeoSmoothing(spl_smpar=state['smoothing'])
+        smoothAlt = linespliner.smooth(diffaltline)
+
+        # Now we reconnect the bit that is different with the smoothed
+        # Segment since smoothing can mess up the intersection
+        reconLine = reconnectLine(centerlineSmooth, smoothAlt)
+        chopped = chopCenterlineEnds(reconLine, state['boundary'])
+    else:
+        chopped = diffaltline
+
+    return chopped
+
+
+def calcAlternateLines(islandIds, workers=1):
+    """
+    Run alternateLine() for a bunch of islands, on a pool of workers if we were asked for one.
+    _ALTLINE_STATE has to be filled before this gets called.
+    :param islandIds: list of island indexes
+    :param workers: how many processes to use. 1 means serial
+    :return: list with alternateLine()'s result for each island, in the same order as islandIds
+    """
+    if workers <= 1 or len(islandIds) <= 1:
+        return [alternateLine(idx) for idx in islandIds]
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        # map() hands the results back in island order so the output matches a serial run
+        return pool.map(alternateLine, islandIds, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
 
 # These are just for graphing
 def centerline(args):
@@ -87,25 +156,55 @@ def centerline(args):
     # splitClockwise gives us our left and right bank polygons
     bankshapes = splitClockwise(rivershapeBounds, newThalweg)
 
-    # Add all the points (including islands) to the list
-    points = []
-
-    # Exterior is the shell and there is only ever 1
-    for pt in list(smoothRiver.exterior.coords):
-        side = 1 if bankshapes[0].contains(Point(pt)) else -1
-        points.append(RiverPoint(pt, interior=False, side=side))
-
-    # Now we consider interiors. NB: Interiors are only qualifying islands in this case
-    for idx, island in enumerate(smoothRiver.interiors):
-        for pt in list(island.coords):
-            side = 1 if bankshapes[0].contains(Point(pt)) else -1
-            points.append(RiverPoint(pt, interior=True, side=side, island=idx))
-
-    # Here's where the Voronoi polygons come into play
-    log.info("Calculating Voronoi Polygons...")
-    myVorL = NARVoronoi(points)
+    tiled = 'tilesize' in args and args.tilesize > 0
+    rasterEngine = 'engine' in args and args.engine == 'raster'
+    diffLines = None
+
+    if rasterEngine:
+        # Find the medial axis on a grid. This doesn't care how many vertices the polygon has
+        log.info("Calculating Raster Medial Axis...")
+        myVorL = None
+        medialAxis = MedialAxisRaster(rivershape, args.cellsize)
+        rasterLine = medialAxis.centerline(lineThalweg.coords[0], lineThalweg.coords[-1])
+        medialAxis = None
+
+        # The path stops at the thalweg ends so push it out to the bounds just like the thalweg
+        # and let chopCenterlineEnds trim it back to the banks
+        rasterStartExt = projToShape(LineString([rasterLine.coords[1], rasterLine.coords[0]]), rivershapeBounds)
+        rasterEndExt = projToShape(LineString([rasterLine.coords[-2], rasterLine.coords[-1]]), rivershapeBounds)
+        rasterlist = list(rasterLine.coords)
+        rasterlist.insert(0, rasterStartExt.coords[1])
+        rasterlist.append(rasterEndExt.coords[1])
+        centerline = LineString(rasterlist)
+    else:
+        # Add all the points (including islands) to the list
+        points = getRiverPoints(smoothRiver, bankshapes[0])
+
+        if 'coarse' in args and args.coarse > 0:
+            # Find a rough centerline from a sparse set of points first, then only keep the dense
+            # points near it. Everywhere else the sparse points are plenty to hold the Voronoi together.
+            log.info("Calculating Coarse Centerline...")
+            coarsePoints = getRiverPoints(densifyShape(rivershape, args.coarse), bankshapes[0])
+            coarseVor = NARVoronoi(coarsePoints)
+            coarseLines = [coarseVor.collectCenterLines(Polygon(rivershape.exterior))]
+            coarseLines += coarseVor.collectAlternateLines().values()
+            coarseVor = None
+
+            points = getCorridorPoints(coarsePoints, points, coarseLines, args.coarse, CORRIDOR_TOLERANCE)
+            log.info("  Using {0} points in the fine pass".format(len(points)))
+
+        # Here's where the Voronoi polygons come into play
+        if tiled:
+            # Long reaches get done one window at a time so we never hold the whole Voronoi diagram.
+            # Tiling always finds the side-channel lines in a single pass.
+            log.info("Calculating Tiled Voronoi Polygons...")
+            myVorL = None
+            centerline, diffLines = tiledCenterline(points, newThalweg, smoothRiver, args.tilesize, args.tileoverlap)
+        else:
+            log.info("Calculating Voronoi Polygons...")
+            myVorL = NARVoronoi(points)
 
-    centerline = myVorL.collectCenterLines(Polygon(rivershape.exterior))
+            centerline = myVorL.collectCenterLines(Polygon(rivershape.exterior))
 
     if (args.smoothing > 0):
         # This is the function that does the actual work of creating the centerline
@@ -115,29 +214,39 @@ def centerline(args):
     else:
         centerlineSmooth = centerline
 
+    # In single pass mode we pull the bit of every alternate line that differs from
+    # the main line out of the Voronoi ridges all at once
+    if myVorL is not None and 'singlepass' in args and args.singlepass:
+        log.info("Collecting Side-Channel Lines in a single pass...")
+        diffLines = myVorL.collectAlternateLines()
+
     # Now we've got the main centerline let's flip the islands one by one
-    # and get alternate lines
-    alternateLines = []
-    for idx, island in enumerate(smoothRiver.interiors):
-        altLine = myVorL.collectCenterLines(Polygon(rivershape.exterior), flipIsland=idx)
-        log.info("  Spline Smoothing Alternate line...")
-        if altLine.type == "LineString":
-            # We difference the alternate lines with the main line
-            # to get just the bit that is different
-            diffaltline = altLine.difference(centerlineSmooth)
-
-            if (args.smoothing > 0):
-                # Now smooth this line to be roughly the consistency of skippy peanut butter
-                smoothAlt = linespliner.smooth(diffaltline)
-
-                # Now we reconnect the bit that is different with the smoothed
-                # Segment since smoothing can mess up the intersection
-                reconLine = reconnectLine(centerlineSmooth, smoothAlt)
-                chopped = chopCenterlineEnds(reconLine, Polygon(rivershape.exterior))
-            else:
-                chopped = diffaltline
-
-            alternateLines.append(chopped)
+    # and get alternate lines. Everything the islands need goes into _ALTLINE_STATE
+    # before the pool forks so the workers inherit the Voronoi arrays instead of
+    # having them pickled across.
+    _ALTLINE_STATE.clear()
+    _ALTLINE_STATE.update({
+        'vor': myVorL,
+        'diffLines': diffLines,
+        'centerlineSmooth': centerlineSmooth,
+        'boundary': Polygon(rivershape.exterior),
+        'smoothing': args.smoothing
+    })
+
+    islandIds = range(len(smoothRiver.interiors))
+    if rasterEngine and len(islandIds) > 0:
+        log.warning("The raster engine only finds the main centerline. Skipping {0} side channels.".format(len(islandIds)))
+        islandIds = []
+
+    workers = args.workers if 'workers' in args and args.workers is not None else 1
+    if workers > 1 and sys.platform == 'win32':
+        log.warning("--workers needs fork() to share the Voronoi arrays. Running serially.")
+        workers = 1
+
+    if workers > 1 and len(islandIds) > 1:
+        log.info("Calculating {0} Side-Channel lines on {1} workers...".format(len(islandIds), workers))
+    alternateLines = [line for line in calcAlternateLines(islandIds, workers) if line is not None]
+    _ALTLINE_STATE.clear()
 
     # Chop the centerline at the ends where it intersects the rivershape
     centerlineChopped = chopCenterlineEnds(centerlineSmooth, Polygon(rivershape.exterior))
@@ -152,25 +261,12 @@ def centerline(args):
     outShape.createField("ID", ogr.OFTInteger)
     outShape.createField("Channel", ogr.OFTString)
 
-    # The main centerline gets written first
-    featureDefn = outShape.layer.GetLayerDefn()
-    outFeature = ogr.Feature(featureDefn)
-    ogrmultiline = ogr.CreateGeometryFromJson(json.dumps(mapping(centerlineChopped)))
-    outFeature.SetGeometry(ogrmultiline)
-    featureID = 1
-    outFeature.SetField('ID', featureID)
-    outFeature.SetField('Channel', 'Main')
-    outShape.layer.CreateFeature(outFeature)
-
-    # We do all this again for each alternate line
-    for altline in alternateLines:
-        newfeat = ogr.Feature(featureDefn)
-        linething = ogr.CreateGeometryFromJson(json.dumps(mapping(altline)))
-        newfeat.SetGeometry(linething)
-        featureID += 1
-        newfeat.SetField('ID', featureID)
-        newfeat.SetField('Channel', 'Side')
-        outShape.layer.CreateFeature(newfeat)
+    # The main centerline gets written first and then each alternate line
+    outLines = [centerlineChopped] + alternateLines
+    outShape.writeFeatures([line.wkb for line in outLines], {
+        'ID': range(1, len(outLines) + 1),
+        'Channel': ['Main'] + ['Side'] * len(alternateLines)
+    })
 
     # --------------------------------------------------------
     # Do a little show and tell with plotting and whatnot
@@ -181,11 +277,13 @@ def centerline(args):
 
         plt = Plotter()
 
-        # (OPTIONAL). Makes the polygons we will use to visualize
-        myVorL.createshapes()
+        # (OPTIONAL). Makes the polygons we will use to visualize. There's no single
+        # Voronoi diagram to draw when we tile
+        if myVorL is not None:
+            myVorL.createshapes()
 
-        # The Voronoi shapes are light grey (really slow for some reason)
-        plt.plotShape(myVorL.polys, '#AAAAAA', 0.3, 0, 'Voronoi Polygon')
+            # The Voronoi shapes are light grey (really slow for some reason)
+            plt.plotShape(myVorL.polys, '#AAAAAA', 0.3, 0, 'Voronoi Polygon')
 
         # Left and right banks are light red and blue
         plt.plotShape(bankshapes[0], '#FFAAAA', 0.5, 5)
@@ -231,6 +329,20 @@ def main():
                         help='The spacing between points (in m) after densification. (default=0.5)',
                         type=float,
                         default=0.5)
+    parser.add_argument('--engine',
+                        help='How to find the centerline: "voronoi" uses the polygon vertices, "raster" uses a distance '
+                             'transform on a grid of --cellsize. (default=voronoi)',
+                        choices=['voronoi', 'raster'],
+                        default='voronoi')
+    parser.add_argument('--cellsize',
+                        help='Cell size (in m) for the raster engine. (default=0.5)',
+                        type=float,
+                        default=0.5)
+    parser.add_argument('--coarse',
+                        help='Spacing (in m) for a coarse first pass. Points are only kept at --density near bends, '
+                             'width changes and narrows in the coarse centerline. (default=0/None)',
+                        type=float,
+                        default=0)
     parser.add_argument('--islands',
                         help='Path to the islands shapefile',
                         type=argparse.FileType('r'))
@@ -238,6 +350,24 @@ def main():
                         type=float,
                         default=0,
                         help='smoothing "s" factor for the curve. (default=0/None)')
+    parser.add_argument('--singlepass',
+                        help='Find all the side-channel lines from one pass over the Voronoi ridges instead of '
+                             'recalculating the centerline for every island (faster on braided reaches)',
+                        action='store_true',
+                        default=False)
+    parser.add_argument('--tilesize',
+                        help='Calculate the centerline in windows this long (in m along the thalweg) to keep '
+                             'memory down on long reaches. (default=0/None)',
+                        type=float,
+                        default=0)
+    parser.add_argument('--tileoverlap',
+                        help='How far (in m) each tile reaches into its neighbours. (default=20)',
+                        type=float,
+                        default=20)
+    parser.add_argument('--workers',
+                        help='Number of processes to use for the side-channel lines. (default=1)',
+                        type=int,
+                        default=1)
     parser.add_argument('--savepng',
                         type=str,
                         help='Provide a path to save the plot to a png')
@@ -1,10 +1,14 @@
 import argparse
+import multiprocessing
 import sys
 from raster import Raster
 from shapes import *
 from metrics import *
+from rays import RayCaster
 from os import path
 from datetime import datetime
+from collections import OrderedDict
+from scipy.spatial import cKDTree
 import itertools
 
 def crosssections(args):
@@ -21,6 +25,14 @@ def crosssections(args):
 
     log = Logger("Cross Sections")
 
+    # Check the metric names now rather than after all the layout work
+    metricNames = None
+    if 'metrics' in args and args.metrics is not None:
+        metricNames = [name.strip() for name in args.metrics.split(',') if len(name.strip()) > 0]
+        unknown = [name for name in metricNames if name not in METRICS]
+        if len(unknown) > 0:
+            raise Exception("Unknown metric(s): {0}".format(", ".join(unknown)))
+
     # --------------------------------------------------------
     # Load the Shapefiles we need
     # --------------------------------------------------------
@@ -45,100 +57,42 @@ def crosssections(args):
     log.info("Combining exterior and qualifying islands...")
     rivershape = Polygon(polyRiverShape.exterior).difference(multipolIslands)
 
-    pointcloud = {
-        "stationsep": [],
-        "separation": []
-    }
-
     # --------------------------------------------------------
     # Traverse the line(s)
     # --------------------------------------------------------
     log.info("Starting Centerline Traversal...")
-
-    class XSObj:
-        def __init__(self, centerlineID, geometry, isMain):
-            self.centerlineID = centerlineID
-            self.geometry = geometry
-            self.metrics = {}
-            self.isValid = False
-            self.isMain = isMain
-            self.queueInvalidate = False
-            self.distance = 0.0
-
-    allxslines = []
-    throwaway = []
-    for line in centerlines:
-        linexs = []
-        linegeo = line['geometry']
-        mainChannel = 'Channel' in line['fields'] and line['fields']['Channel'] == "Main"
-        channelID = line['fields']['ID']
-
-        # Get 50cm spaced points
-        for currDist in np.arange(0, linegeo.length, args.separation):
-            # Now create the cross sections with length = 2 * diag
-            newxs, junk, pt = createTangentialIntersect(currDist, linegeo, rivershape)
-            throwaway += junk
-
-            # If the points flag is set we add this point to a dictionary for later
-            # Writing to the shp file
-            if args.points:
-                pointcloud['separation'].append(pt)
-
-            keep = True
-            if newxs is None:
-                keep = False
-            else:
-                xsObj = XSObj(channelID, newxs, mainChannel)
-
-                # Store the distance down the centerline as a metric on the cross section.
-                # Note that side channels will start from zero.
-                xsObj.distance = currDist
-
-                # If this is not the main channel and our cross section touches the exterior wall in
-                # more than one place then lose it
-                if not mainChannel:
-                    dista = Point(newxs.coords[0]).distance(rivershape.exterior)
-                    distb = Point(newxs.coords[1]).distance(rivershape.exterior)
-                    if dista < 0.001 and distb < 0.001:
-                        keep = False
-
-                if keep:
-                    linexs.append(xsObj)
-                else:
-                    throwaway.append(newxs)
-
-        allxslines.append(linexs)
+    # Throwaway lines are only ever used for plotting so don't hang onto them otherwise
+    workers = args.workers if 'workers' in args and args.workers is not None else 1
+    if workers > 1 and sys.platform == 'win32':
+        log.warning("--workers needs fork() to share the river shape and DEM. Running serially.")
+        workers = 1
+
+    layout = layoutCrossSections(centerlines, rivershape, args.separation, keepThrowaway=not args.noviz,
+                                 keepStations=args.points, workers=workers)
+    numxs = len(layout['distance'])
+    if numxs == 0:
+        raise Exception("No cross sections found along any of the centerlines")
 
     # --------------------------------------------------------
     # Valid/invalid line testing
     # --------------------------------------------------------
     log.info("Testing XSs for Validity...")
+    xsset = CrossSectionSet.fromLayout(layout)
+    xsset.isValid[:] = xsLengthValidate(xsset.lengths(), xsset.line)
+    xsset.isValid[:] = xsOverlapValidate(xsset.endpoints, xsset.line, xsset.isValid)
 
-    for linexs in allxslines:
-        xsValueValidate(linexs)
-
-    xsOverlapValidate(allxslines)
-
+    # With --chunksize only one chunk worth of metrics (and station points) is in memory at a time
+    streaming = 'chunksize' in args and args.chunksize > 0
+    chunksize = args.chunksize if streaming else numxs
 
     # --------------------------------------------------------
-    # Metric Calculation
+    # Metric Calculation and writing the output Shapefile(s)
     # --------------------------------------------------------
-    # Flatten the list
-    log.info("Calculating metrics for all crosssections")
-    flatxsl = [xs for xslist in allxslines for xs in xslist]
-    dem = Raster(args.dem.name)
-    for idx, xs in enumerate(flatxsl):
-        ptsdict = calcXSMetrics(xs, polyRiverShape, dem, args.stationsep)
-        # Add all station points to stationsep for writing to the shapefile
-        if args.points:
-            ptsdict['xsid'] = idx
-            pointcloud['stationsep'].append(ptsdict)
+    log.info("Calculating metrics and writing XSs to Shapefiles...")
+    # With --demcachedir we only keep the part of the DEM under the river (every station is inside it)
+    dem = Raster(args.dem.name, cacheMB=args.demcache if 'demcache' in args and args.demcache is not None else 0,
+                 cacheDir=args.demcachedir if 'demcachedir' in args else None, extent=polyRiverShape.bounds)
 
-
-    # --------------------------------------------------------
-    # Write the output Shapefile
-    # --------------------------------------------------------
-    log.info("Writing XSs to Shapefiles...")
     outShape = Shapefile()
     outShape.create(args.crosssections, rivershp.spatialRef, geoType=ogr.wkbLineString)
 
@@ -150,75 +104,63 @@ def crosssections(args):
     # fields that are defined during XS creation. These are things like file paths etc.
     AddMetaFields(outShape)
 
-    for metricName, metricValue in flatxsl[0].metrics.iteritems():
-        outShape.createField(metricName, ogr.OFTReal)
-
-    for idx, xs in enumerate(flatxsl):
-        featureDefn = outShape.layer.GetLayerDefn()
-        outFeature = ogr.Feature(featureDefn)
-        ogrLine = ogr.CreateGeometryFromJson(json.dumps(mapping(xs.geometry)))
-        outFeature.SetGeometry(ogrLine)
-
-        # Set some metadata fields
-        outFeature.SetField("ID", int(idx))
-        outFeature.SetField("isValid", int(xs.isValid))
-        outFeature.SetField("Name", "Cross Section {0}".format(idx))
-        outFeature.SetField("Date", datetime.now().strftime('%Y-%m-%d'))
-        outFeature.SetField("CLine", path.abspath(args.centerline.name))
-        outFeature.SetField("DEM", path.abspath(args.dem.name))
-        outFeature.SetField("Banks", path.abspath(args.river.name))
-        outFeature.SetField("Extension", 0) # lateral extension currently always zero
-        outFeature.SetField("StatSep", args.stationsep)
-        outFeature.SetField("Distance", xs.distance)
-
-        if xs.isMain:
-            outFeature.SetField('Channel', 'Main')
-        else:
-            outFeature.SetField('Channel', 'Side')
+    if args.points:
+        pointsShape = Shapefile()
+        newname = "{0}_points.shp".format(os.path.splitext(args.crosssections)[0])
+        pointsShape.create(newname, rivershp.spatialRef, geoType=ogr.wkbPoint)
+
+        pointsShape.createField("ID", ogr.OFTInteger)
+        pointsShape.createField("xsID", ogr.OFTInteger)
+        pointsShape.createField("type", ogr.OFTString)
+        pointsShape.createField("val", ogr.OFTReal)
+
+    # Everything the metrics need goes into _METRICS_STATE before the pool forks. The DEM goes
+    # into shared memory first so the workers all read the same copy of it.
+    _METRICS_STATE.clear()
+    _METRICS_STATE.update({
+        'dem': dem,
+        'rivershape': polyRiverShape,
+        # Index the boundary (donuts and all) once for the wet widths instead of once per block.
+        # Not worth doing at all if none of the metrics we're after need it.
+        'caster': RayCaster(polyRiverShape) if 'caster' in metricInputs(metricNames) else None,
+        'stationsep': args.stationsep,
+        'sampling': args.sampling if 'sampling' in args and args.sampling is not None else 'nearest',
+        'metrics': metricNames,
+        'points': args.points
+    })
+    pool = None
+    if workers > 1:
+        log.info("Calculating metrics on {0} workers...".format(workers))
+        dem.toSharedMemory()
+        pool = multiprocessing.Pool(workers)
+
+    try:
+        for first in range(0, numxs, chunksize):
+            last = min(first + chunksize, numxs)
+            if streaming:
+                log.info("  Cross sections {0} to {1} of {2}".format(first, last - 1, numxs))
+            # The chunk shares isValid with xsset so metrics invalidating things shows up there too
+            chunkxs = xsset.subset(first, last)
 
-        # Now write all the metrics to a file
-        for metricName, metricValue in xs.metrics.iteritems():
-            try:
-                # print "{0} ==> {1}".format(metricName, metricValue)
-                outFeature.SetField(metricName, metricValue)
-            except NotImplementedError as e:
-                log.error("OGR SetField Error", e)
+            stationPoints = calcChunkMetrics(chunkxs, pool)
 
-        outShape.layer.CreateFeature(outFeature)
+            # The metric fields come from the first chunk
+            if first == 0:
+                for metricName in chunkxs.metrics.iterkeys():
+                    outShape.createField(metricName, ogr.OFTReal)
+
+            writeCrossSections(outShape, chunkxs, first, args)
+            if args.points:
+                writeStationPoints(pointsShape, stationPoints, first)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _METRICS_STATE.clear()
 
     if args.points:
         log.info("Writing Points...")
-        outShape = Shapefile()
-        newname = "{0}_points.shp".format(os.path.splitext(args.crosssections)[0])
-        outShape.create(newname, rivershp.spatialRef, geoType=ogr.wkbPoint)
-
-        outShape.createField("ID", ogr.OFTInteger)
-        outShape.createField("xsID", ogr.OFTInteger)
-        outShape.createField("type", ogr.OFTString)
-        outShape.createField("val", ogr.OFTReal)
-
-        featureDefn = outShape.layer.GetLayerDefn()
-        for idx, xspts in enumerate(pointcloud['stationsep']):
-            for idy, pt in enumerate(xspts['points']):
-                outFeature = ogr.Feature(featureDefn)
-                ogrPt = ogr.CreateGeometryFromJson(json.dumps(mapping(pt)))
-                outFeature.SetGeometry(ogrPt)
-                outFeature.SetField("ID", int(idx))
-                outFeature.SetField("val", float(xspts['values'][idy]))
-                outFeature.SetField("type", "stationsep")
-                outFeature.SetField("xsID", int(xspts['xsid']))
-                outShape.layer.CreateFeature(outFeature)
-
-        for idx, pt in enumerate(pointcloud['separation']):
-            outFeature = ogr.Feature(featureDefn)
-            ogrPt = ogr.CreateGeometryFromJson(json.dumps(mapping(pt)))
-            outFeature.SetGeometry(ogrPt)
-            outFeature.SetField("ID", int(idx))
-            outFeature.SetField("type", "separation")
-            outFeature.SetField("val", 0)
-            outFeature.SetField("xsID", idx)
-            outShape.layer.CreateFeature(outFeature)
-
+        writeSeparationPoints(pointsShape, layout['stations'])
 
     # --------------------------------------------------------
     # Do a little show and tell with plotting and whatnot
@@ -228,6 +170,7 @@ def crosssections(args):
         log.info("Plotting Results...")
 
         plt = Plotter()
+        xsgeoms = [LineString(endpoints) for endpoints in layout['endpoints']]
 
         # The shape of the river is grey (this is the one with only qualifying islands
         plt.plotShape(rivershape, '#CCCCCC', 0.5, 5, 'River Shape')
@@ -236,13 +179,13 @@ def crosssections(args):
         plt.plotShape(MultiLineString([g['geometry'] for g in centerlines]), '#000000', 0.5, 20, "Centerlines")
 
         # Throwaway lines (the ones that are too whack to even test for validity) are faded red
-        plt.plotShape(MultiLineString(throwaway), '#FF0000', 0.3, 20, "Throwaway Lines (not stored)")
+        plt.plotShape(MultiLineString(layout['throwaway']), '#FF0000', 0.3, 20, "Throwaway Lines (not stored)")
 
         # Invalid crosssections are orange
-        plt.plotShape(MultiLineString([g.geometry for g in flatxsl if not g.isValid]), '#00FF00', 0.7, 25, "Invalid Cross Sections")
+        plt.plotShape(MultiLineString([g for g, v in zip(xsgeoms, xsset.isValid) if not v]), '#00FF00', 0.7, 25, "Invalid Cross Sections")
 
         # The valid crosssections are blue
-        plt.plotShape(MultiLineString([g.geometry for g in flatxsl if g.isValid]), '#0000FF', 0.7, 30, "Valid Cross Sections")
+        plt.plotShape(MultiLineString([g for g, v in zip(xsgeoms, xsset.isValid) if v]), '#0000FF', 0.7, 30, "Valid Cross Sections")
 
         bounds = getBufferedBounds(rivershape, 10).bounds
         if 'savepng' in args and args.savepng is not None:
@@ -251,6 +194,340 @@ def crosssections(args):
             plt.showPlot(bounds)
 
 
+class CrossSectionSet:
+    """
+    All the cross sections as columns (one array per attribute and one per metric) instead of an
+    object each. Shapely geometries only get built when something asks for one.
+    """
+
+    def __init__(self, endpoints, line, distance, lineIDs, lineMain):
+        """
+        :param endpoints: (N, 2, 2) array with the start and end of each cross section
+        :param line: (N,) index of the centerline each one came from
+        :param distance: (N,) distance down that centerline
+        :param lineIDs: ID of each centerline
+        :param lineMain: Main channel flag for each centerline
+        """
+        self.endpoints = endpoints
+        self.line = line
+        self.distance = distance
+        self.lineIDs = lineIDs
+        self.lineMain = np.asarray(lineMain, dtype=bool)
+        self.isValid = np.zeros(len(distance), dtype=bool)
+        # {name: (N,) array} in METRICS order (see calcChunkMetrics)
+        self.metrics = OrderedDict()
+
+    @classmethod
+    def fromLayout(cls, layout):
+        """
+        :param layout: from layoutCrossSections()
+        :return: CrossSectionSet (sharing the layout's arrays)
+        """
+        return cls(layout['endpoints'], layout['line'], layout['distance'], layout['lineIDs'], layout['lineMain'])
+
+    def __len__(self):
+        return len(self.distance)
+
+    def lengths(self):
+        """
+        :return: (N,) array of cross section lengths
+        """
+        return np.hypot(*(self.endpoints[:, 1] - self.endpoints[:, 0]).T)
+
+    def isMain(self):
+        """
+        :return: (N,) boolean array. True for cross sections on the main channel
+        """
+        return self.lineMain[self.line]
+
+    def geometry(self, idx):
+        """
+        :param idx: Index of the cross section
+        :return: LineString
+        """
+        return LineString(self.endpoints[idx])
+
+    def subset(self, first, last):
+        """
+        A contiguous run of cross sections. The columns are views so changing isValid (or a metric)
+        on the subset changes it here too.
+        :param first: Index of the first cross section
+        :param last: One past the index of the last one
+        :return: CrossSectionSet
+        """
+        sub = CrossSectionSet(self.endpoints[first:last], self.line[first:last], self.distance[first:last],
+                              self.lineIDs, self.lineMain)
+        sub.isValid = self.isValid[first:last]
+        sub.metrics = OrderedDict((name, values[first:last]) for name, values in self.metrics.iteritems())
+        return sub
+
+
+# Everything a layout worker needs. This gets filled before the pool forks so the workers inherit
+# the ray caster and the centerlines instead of having them pickled across.
+_LAYOUT_STATE = {}
+
+# How many stations go into one layout task. Small enough that one long line still gets spread
+# across all the workers.
+LAYOUT_BLOCK = 2000
+
+
+def layoutBlock(task):
+    """
+    Lay out the cross sections for one block of stations along one centerline. This runs either
+    serially or inside a worker process so it only reads from _LAYOUT_STATE
+    :param task: (lineIdx, first, last) the centerline and the range of station indices along it
+    :return: (stations, endpoints, distances, throwaway) for the block. stations is None unless we
+             are keeping them.
+    """
+    state = _LAYOUT_STATE
+    lineIdx, first, last = task
+    linegeo = state['centerlines'][lineIdx]['geometry']
+    mainChannel = state['lineMain'][lineIdx]
+    exterior = state['rivershape'].exterior
+
+    # Get 50cm spaced points and the normals there all at once
+    distances = np.arange(0, linegeo.length, state['separation'])[first:last]
+    stations, normals = getStationNormals(linegeo, distances)
+
+    # Now cast the cross sections out to the banks
+    newxslines = state['caster'].castCrossSections(stations, normals)
+
+    endpoints = []
+    keptDistances = []
+    throwaway = []
+    for currDist, newxs in zip(distances, newxslines):
+        if newxs is None:
+            continue
+
+        # If this is not the main channel and our cross section touches the exterior wall in
+        # more than one place then lose it
+        keep = True
+        if not mainChannel:
+            dista = Point(newxs.coords[0]).distance(exterior)
+            distb = Point(newxs.coords[-1]).distance(exterior)
+            if dista < 0.001 and distb < 0.001:
+                keep = False
+
+        if keep:
+            endpoints.append((newxs.coords[0], newxs.coords[-1]))
+            # Store the distance down the centerline as a metric on the cross section.
+            # Note that side channels will start from zero.
+            keptDistances.append(currDist)
+        elif state['keepThrowaway']:
+            throwaway.append(newxs)
+
+    return stations if state['keepStations'] else None, \
+        np.array(endpoints, dtype=np.float64).reshape(-1, 2, 2), \
+        np.array(keptDistances, dtype=np.float64), throwaway
+
+
+def layoutCrossSections(centerlines, rivershape, separation, keepThrowaway=False, keepStations=False,
+                        workers=1):
+    """
+    First pass down the centerlines. Lay out every cross section but only hang onto what we need to
+    validate them and to build them again later, all in compact arrays.
+    :param centerlines: list of {'geometry', 'fields'} dictionaries from featuresToShapely()
+    :param rivershape: River shape with qualifying islands as donuts
+    :param separation: Downstream spacing between cross sections
+    :param keepThrowaway: Keep the lines that don't make the cut (for plotting)
+    :param keepStations: Keep every station point (for the separation points output)
+    :param workers: Number of processes to spread the stations across
+    :return: dictionary with:
+                'endpoints': (N, 2, 2) start and end of every cross section
+                'line': (N,) index of the centerline each one came from
+                'distance': (N,) distance down that centerline
+                'lineIDs', 'lineMain': the ID and main channel flag for each centerline
+                'stations': (S, 2) every station point (including ones that didn't get a cross section).
+                            Empty unless keepStations is set.
+                'throwaway': list of LineStrings we didn't keep
+    """
+    log = Logger("Layout")
+    lineIDs = [line['fields']['ID'] for line in centerlines]
+    lineMain = ['Channel' in line['fields'] and line['fields']['Channel'] == "Main" for line in centerlines]
+
+    # Every line and every block of stations along a line is independent so they are all separate tasks
+    tasks = []
+    for lineIdx, line in enumerate(centerlines):
+        numStations = len(np.arange(0, line['geometry'].length, separation))
+        for first in range(0, numStations, LAYOUT_BLOCK):
+            tasks.append((lineIdx, first, min(first + LAYOUT_BLOCK, numStations)))
+
+    _LAYOUT_STATE.clear()
+    _LAYOUT_STATE.update({
+        'caster': RayCaster(rivershape),
+        'rivershape': rivershape,
+        'centerlines': centerlines,
+        'lineMain': lineMain,
+        'separation': separation,
+        'keepThrowaway': keepThrowaway,
+        'keepStations': keepStations
+    })
+
+    if workers > 1 and sys.platform == 'win32':
+        log.warning("--workers needs fork() to share the river shape. Running serially.")
+        workers = 1
+
+    if workers > 1 and len(tasks) > 1:
+        log.info("Laying out {0} blocks of stations on {1} workers...".format(len(tasks), workers))
+        pool = multiprocessing.Pool(workers)
+        try:
+            # map() hands the results back in task order so the output matches a serial run
+            results = pool.map(layoutBlock, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [layoutBlock(task) for task in tasks]
+
+    _LAYOUT_STATE.clear()
+
+    layout = {
+        'endpoints': [np.zeros((0, 2, 2))],
+        'line': [np.zeros(0, dtype=np.int32)],
+        'distance': [np.zeros(0)],
+        'lineIDs': lineIDs,
+        'lineMain': lineMain,
+        'stations': [np.zeros((0, 2))],
+        'throwaway': []
+    }
+    for (lineIdx, first, last), (stations, endpoints, distances, throwaway) in zip(tasks, results):
+        if stations is not None:
+            layout['stations'].append(stations)
+        layout['endpoints'].append(endpoints)
+        layout['line'].append(np.full(len(distances), lineIdx, dtype=np.int32))
+        layout['distance'].append(distances)
+        layout['throwaway'] += throwaway
+
+    for key in ['endpoints', 'line', 'distance', 'stations']:
+        layout[key] = np.concatenate(layout[key])
+    return layout
+
+
+# Everything a metrics worker needs (the DEM, the river shape etc.). Filled before the pool forks.
+_METRICS_STATE = {}
+
+# How many cross sections go to a metrics worker at a time
+METRICS_BLOCK = 50
+
+
+def metricsBlock(xsset):
+    """
+    Calculate the metrics for a block of cross sections. This runs either serially or inside a
+    worker process so it only reads from _METRICS_STATE
+    :param xsset: CrossSectionSet
+    :return: (metric items, valid, stations). valid is False wherever the metrics found a problem and
+             stations is None unless we are writing them out.
+    """
+    state = _METRICS_STATE
+
+    # Sample the DEM at every station of every cross section in the block all at once
+    stations = sampleStations(xsset.endpoints, state['dem'], state['stationsep'], state['sampling'])
+
+    # Then every metric for the whole block in one go
+    metrics, valid = calcMetrics(xsset.endpoints, stations, state['rivershape'], state['metrics'], state['caster'])
+
+    return metrics.items(), valid, stations if state['points'] else None
+
+
+def calcChunkMetrics(xsset, pool=None):
+    """
+    Calculate the metrics for a set of cross sections, spread across a process pool if there is one.
+    This fills in xsset.metrics and invalidates anything the metrics didn't like.
+    :param xsset: CrossSectionSet
+    :param pool: multiprocessing.Pool (or None to do it here)
+    :return: The stations for every cross section as one ragged dictionary (see sampleStations) or
+             None if we're not keeping them
+    """
+    if pool is None:
+        results = [metricsBlock(xsset)]
+    else:
+        blocks = [xsset.subset(idx, idx + METRICS_BLOCK) for idx in range(0, len(xsset), METRICS_BLOCK)]
+        # map() hands the blocks back in order so everything lines up with xsset again
+        results = pool.map(metricsBlock, blocks, chunksize=1)
+
+    # Stitch the blocks back together. The metrics come back as items (in METRICS order) so the metric
+    # fields come out in the same order whether we use a pool or not
+    xsset.metrics = OrderedDict()
+    for colIdx, (name, values) in enumerate(results[0][0]):
+        xsset.metrics[name] = np.concatenate([metrics[colIdx][1] for metrics, valid, stations in results])
+    xsset.isValid &= np.concatenate([valid for metrics, valid, stations in results])
+
+    if results[0][2] is None:
+        return None
+
+    offsets = [np.zeros(1, dtype=np.int64)]
+    for metrics, valid, stations in results:
+        offsets.append(stations['offsets'][1:] + offsets[-1][-1])
+    return {
+        "points": np.concatenate([stations['points'] for metrics, valid, stations in results]),
+        "values": np.ma.concatenate([stations['values'] for metrics, valid, stations in results]),
+        "offsets": np.concatenate(offsets)
+    }
+
+
+def writeCrossSections(outShape, xsset, firstIdx, args):
+    """
+    Write cross sections (and their metrics) to the output shapefile
+    :param outShape: Shapefile with all the fields already created
+    :param xsset: CrossSectionSet
+    :param firstIdx: ID of the first cross section in the set
+    :param args: The command line arguments (for the metadata fields)
+    :return:
+    """
+    ids = np.arange(firstIdx, firstIdx + len(xsset))
+    fields = OrderedDict([
+        ("ID", ids),
+        ("isValid", xsset.isValid.astype(np.int32)),
+        ("Name", ["Cross Section {0}".format(idx) for idx in ids]),
+        ("Distance", xsset.distance),
+        ("Channel", np.where(xsset.isMain(), 'Main', 'Side'))
+    ])
+    # Now all the metrics
+    fields.update(xsset.metrics)
+
+    # The metadata that's the same for every cross section
+    constants = {
+        "Date": datetime.now().strftime('%Y-%m-%d'),
+        "CLine": path.abspath(args.centerline.name),
+        "DEM": path.abspath(args.dem.name),
+        "Banks": path.abspath(args.river.name),
+        "Extension": 0,  # lateral extension currently always zero
+        "StatSep": args.stationsep
+    }
+
+    # Cross sections are always straight so the endpoints are the whole geometry
+    outShape.writeFeatures(xsset.endpoints, fields, constants)
+
+
+def writeStationPoints(outShape, stationPoints, firstIdx):
+    """
+    Write the points we sampled the DEM at along each cross section
+    :param outShape: The points Shapefile
+    :param stationPoints: Ragged station dictionary from calcChunkMetrics()
+    :param firstIdx: ID of the first cross section
+    :return:
+    """
+    xsIDs = np.repeat(np.arange(firstIdx, firstIdx + len(stationPoints['offsets']) - 1), np.diff(stationPoints['offsets']))
+    fields = {
+        "ID": xsIDs,
+        "xsID": xsIDs,
+        # Anything without a DEM value goes in as nan
+        "val": np.ma.filled(stationPoints['values'].astype(np.float64), np.nan)
+    }
+    outShape.writeFeatures(stationPoints['points'], fields, {"type": "stationsep"})
+
+
+def writeSeparationPoints(outShape, stations):
+    """
+    Write the station points down the centerlines
+    :param outShape: The points Shapefile
+    :param stations: (N, 2) array of points
+    :return:
+    """
+    ids = np.arange(len(stations))
+    outShape.writeFeatures(stations, {"ID": ids, "xsID": ids}, {"type": "separation", "val": 0})
+
+
 def AddMetaFields(outShape):
 
     # Field to store the date that the cross sections were generated
@@ -286,51 +563,106 @@ def AddMetaFields(outShape):
     # Distance of the cross section down the centerline
     outShape.createField("Distance", ogr.OFTReal)
 
-def xsValueValidate(linexs):
+def xsLengthValidate(lengths, lines):
     """
-    Validate each XS in a line based on the average stats
-    for that line
-    :param linexs:
-    :return:
+    A cross section is valid unless it is more than 4 standard deviations longer than the mean
+    for its line.
+    :param lengths: (N,) array of cross section lengths
+    :param lines: (N,) array of the line index of each cross section
+    :return: (N,) boolean array
     """
-    lengths = [xs.geometry.length for xs in linexs]
-    stdev = np.std(lengths)
-    mean = np.mean(lengths)
-
-    # Test each cross section for validity.
-    # TODO: Right now it's just stddev test. There should probably be others
-    for idx, xsobj in enumerate(linexs):
-        isValid = not xsobj.geometry.length > (mean + 4 * stdev)
-        xsobj.isValid = isValid
+    counts = np.maximum(np.bincount(lines), 1).astype(np.float64)
+    mean = np.bincount(lines, weights=lengths) / counts
+    stdev = np.sqrt(np.bincount(lines, weights=(lengths - mean[lines]) ** 2) / counts)
+    return ~(lengths > mean[lines] + 4 * stdev[lines])
 
 
-def xsOverlapValidate(allxslines):
+def xsOverlapValidate(endpoints, lines, valid, chunksize=10000):
     """
-    See if any valid cross sections overlap XSs from any other line and
-    invalidate everything!
-    :return: Nothing. This edits in place.
+    Any valid cross section that crosses (or touches) a valid cross section from another line
+    is invalid. Cross sections are always straight so their endpoints are all we need: no
+    geometries and no spatial index beyond a KD-tree of their midpoints.
+    :param endpoints: (N, 2, 2) array of cross section endpoints
+    :param lines: (N,) array of the line index of each cross section
+    :param valid: (N,) boolean array
+    :param chunksize: How many cross sections to look for neighbours of at once
+    :return: (N,) boolean array
     """
-    # Loop over lines
-    invalidate = []
-    for linecombo in itertools.combinations(allxslines, 2):
-        xslist0 = [xs for xs in linecombo[0] if xs.isValid]
-        xslist1 = [xs for xs in linecombo[1] if xs.isValid]
+    validIdx = np.flatnonzero(valid)
+    newValid = valid.copy()
+    if len(validIdx) < 2:
+        return newValid
+
+    ends = endpoints[validIdx]
+    xslines = lines[validIdx]
+    mids = ends.mean(axis=1)
+    halfLengths = np.hypot(*(ends[:, 1] - ends[:, 0]).T) / 2
+
+    # Two cross sections can only cross if their midpoints are closer than their half lengths put
+    # together, which is never more than twice the longer one. So each cross section only has to look
+    # for shorter ones within twice its own half length. We work through them sorted by length in
+    # chunks that never mix lengths more than 2x apart so a few long ones don't blow up the search
+    # radius for everything else.
+    tree = cKDTree(mids)
+    byLength = np.argsort(halfLengths, kind='mergesort')
+    sortedHalf = halfLengths[byLength]
+    rank = np.empty(len(validIdx), dtype=np.int64)
+    rank[byLength] = np.arange(len(validIdx))
+
+    invalidate = np.zeros(len(validIdx), dtype=bool)
+    first = 0
+    while first < len(validIdx):
+        last = min(first + chunksize, max(first + 1, np.searchsorted(sortedHalf, 2 * sortedHalf[first], side='right')))
+        idx = byLength[first:last]
+        first = last
+        candidates = tree.query_ball_point(mids[idx], 2 * halfLengths[idx[-1]])
+        counts = np.array([len(c) for c in candidates])
+        pairA = np.repeat(idx, counts)
+        pairB = np.fromiter(itertools.chain.from_iterable(candidates), dtype=np.int64, count=np.sum(counts))
+
+        # Each pair once (the longer one finds the shorter one) and never two from the same line
+        keep = (rank[pairB] < rank[pairA]) & (xslines[pairA] != xslines[pairB])
+        keep[keep] = np.hypot(*(mids[pairA[keep]] - mids[pairB[keep]]).T) <= halfLengths[pairA[keep]] + halfLengths[pairB[keep]]
+        pairA = pairA[keep]
+        pairB = pairB[keep]
+
+        hit = segmentsIntersect(ends[pairA], ends[pairB])
+        invalidate[pairA[hit]] = True
+        invalidate[pairB[hit]] = True
+
+    newValid[validIdx[invalidate]] = False
+    return newValid
+
+
+def segmentsIntersect(segsA, segsB):
+    """
+    Do pairs of line segments touch or cross?
+    :param segsA: (N, 2, 2) array of segments
+    :param segsB: (N, 2, 2) array of segments
+    :return: (N,) boolean array
+    """
+    def orientation(a, b, c):
+        return np.sign((b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1]) - (b[:, 1] - a[:, 1]) * (c[:, 0] - a[:, 0]))
+
+    p1, q1 = segsA[:, 0], segsA[:, 1]
+    p2, q2 = segsB[:, 0], segsB[:, 1]
+    o1 = orientation(p1, q1, p2)
+    o2 = orientation(p1, q1, q2)
+    o3 = orientation(p2, q2, p1)
+    o4 = orientation(p2, q2, q1)
 
-        for xs in xslist0:
-            for xsTest in xslist1:
-                if xs.isValid and xsTest.isValid and xs.geometry.intersects(xsTest.geometry):
-                    invalidate.append((xs.centerlineID, xs))
-                    xs.queueInvalidate = True
-                    xsTest.queueInvalidate = True
+    crossing = (o1 * o2 <= 0) & (o3 * o4 <= 0)
 
-    # Now do the actual work
-    for line in allxslines:
-        for xs in line:
-            if xs.queueInvalidate:
-                xs.queueInvalidate = False
-                xs.isValid = False
+    # If everything is in a line then they only touch if their boxes overlap
+    collinear = (o1 == 0) & (o2 == 0)
+    boxes = np.all((np.minimum(p1, q1) <= np.maximum(p2, q2)) & (np.minimum(p2, q2) <= np.maximum(p1, q1)), axis=1)
 
+    # A zero length segment is in line with everything (o1 and o2 are always 0) so the box test would
+    # say it touches anything whose box it sits in. Shapely (GEOS) says a zero length line doesn't
+    # intersect anything at all, even when it sits right on the other line, so we do the same.
+    degenerate = np.all(p1 == q1, axis=1) | np.all(p2 == q2, axis=1)
 
+    return ~degenerate & np.where(collinear, boxes, crossing)
 
 
 def main():
@@ -366,6 +698,28 @@ def main():
                         help = 'Generate points at separation and stationsep (slower)',
                         action='store_true',
                         default=False)
+    parser.add_argument('--sampling',
+                        choices=['nearest', 'bilinear'],
+                        help='How to sample the DEM at each station. "bilinear" interpolates between cell centers (default=nearest)',
+                        default='nearest')
+    parser.add_argument('--demcache',
+                        type=int,
+                        help='Read the DEM lazily in blocks around the cross sections, keeping at most this many MB of them in memory. 0 reads the whole DEM up front (default=0)',
+                        default=0)
+    parser.add_argument('--demcachedir',
+                        type=str,
+                        help='Keep a memory-mapped copy of the DEM (clipped to the river) in this folder and reuse it on later runs until the DEM changes. Overrides --demcache')
+    parser.add_argument('--metrics',
+                        type=str,
+                        help='Comma separated list of the metrics to calculate. Choose from: {0} (default=all of them)'.format(', '.join(METRICS.keys())))
+    parser.add_argument('--chunksize',
+                        type=int,
+                        help='Stream the cross sections through metrics and output this many at a time to keep memory flat on long reaches. 0 keeps everything in memory (default=0)',
+                        default=0)
+    parser.add_argument('--workers',
+                        type=int,
+                        help='Number of processes to use for laying out the cross sections and calculating metrics. (default=1)',
+                        default=1)
     parser.add_argument('--noviz',
                         help = 'Disable result visualization (faster)',
                         action='store_true',
@@ -0,0 +1,117 @@
+import numpy as np
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import dijkstra
+from shapely.geometry import *
+from shapely.vectorized import contains
+from logger import Logger
+
+
+class MedialAxisRaster:
+    """
+    An alternative to NARVoronoi that finds the centerline on a grid instead of from the polygon
+    vertices. The polygon gets rasterized, we take the distance from every wet cell to the nearest
+    dry one and then walk the cheapest path between two points where "cheap" means "far from the banks".
+    The cost scales with area / cellSize^2 so it doesn't care how many vertices the polygon has.
+    """
+
+    # Cells get a cost of 1/distance^COST_POWER. Higher values hug the ridge of the distance
+    # transform more tightly.
+    COST_POWER = 2
+
+    def __init__(self, rivershape, cellSize):
+        """
+        Rasterize the river shape and calculate the distance transform
+        :param rivershape: Polygon (donuts are treated as dry)
+        :param cellSize: Size of a grid cell in map units
+        """
+        self.log = Logger('MedialAxisRaster')
+        self.cellSize = float(cellSize)
+
+        # Pad by a cell on every side so the banks are always dry cells
+        minx, miny, maxx, maxy = rivershape.bounds
+        self.left = minx - self.cellSize
+        self.top = maxy + self.cellSize
+        self.cols = int(np.ceil((maxx - minx) / self.cellSize)) + 2
+        self.rows = int(np.ceil((maxy - miny) / self.cellSize)) + 2
+
+        xs = self.left + (np.arange(self.cols) + 0.5) * self.cellSize
+        ys = self.top - (np.arange(self.rows) + 0.5) * self.cellSize
+        gridx, gridy = np.meshgrid(xs, ys)
+        self.wet = contains(rivershape, gridx, gridy)
+
+        # Distance (in map units) from every wet cell to the closest dry one
+        self.distance = ndimage.distance_transform_edt(self.wet) * self.cellSize
+
+    def cellCenter(self, row, col):
+        """
+        Map coordinates of the middle of a cell
+        :param row:
+        :param col:
+        :return: (x, y) tuple (or arrays if you hand in arrays)
+        """
+        return self.left + (col + 0.5) * self.cellSize, self.top - (row + 0.5) * self.cellSize
+
+    def nearestWetCell(self, pt):
+        """
+        Find the flat index of the wet cell closest to a point
+        :param pt: (x, y) tuple
+        :return: index into self.wet.ravel()
+        """
+        wetidx = np.flatnonzero(self.wet)
+        rows, cols = np.unravel_index(wetidx, self.wet.shape)
+        x, y = self.cellCenter(rows, cols)
+        return wetidx[np.argmin((x - pt[0]) ** 2 + (y - pt[1]) ** 2)]
+
+    def centerline(self, start, end):
+        """
+        Find the medial path between two points
+        :param start: (x, y) to start near (usually the start of the thalweg)
+        :param end: (x, y) to end near (usually the end of the thalweg)
+        :return: LineString
+        """
+        wetidx = np.flatnonzero(self.wet)
+        # Map from flat grid index to node number in the graph
+        nodes = np.full(self.wet.size, -1, dtype=np.int64)
+        nodes[wetidx] = np.arange(len(wetidx))
+
+        cost = 1.0 / np.power(self.distance.ravel()[wetidx], self.COST_POWER)
+
+        # Build an 8-connected graph. We only need half the neighbours since it's undirected
+        rows, cols = np.unravel_index(wetidx, self.wet.shape)
+        src = []
+        dst = []
+        weights = []
+        for drow, dcol in [(0, 1), (1, 0), (1, 1), (1, -1)]:
+            nrows = rows + drow
+            ncols = cols + dcol
+            inside = (nrows < self.rows) & (ncols >= 0) & (ncols < self.cols)
+            neighbour = np.full(len(wetidx), -1, dtype=np.int64)
+            neighbour[inside] = nodes[nrows[inside] * self.cols + ncols[inside]]
+            valid = np.flatnonzero(neighbour >= 0)
+
+            steplength = self.cellSize * np.hypot(drow, dcol)
+            src.append(valid)
+            dst.append(neighbour[valid])
+            weights.append(steplength * 0.5 * (cost[valid] + cost[neighbour[valid]]))
+
+        src = np.concatenate(src)
+        dst = np.concatenate(dst)
+        graph = coo_matrix((np.concatenate(weights), (src, dst)), shape=(len(wetidx), len(wetidx))).tocsr()
+
+        startnode = nodes[self.nearestWetCell(start)]
+        endnode = nodes[self.nearestWetCell(end)]
+        dists, predecessors = dijkstra(graph, directed=False, indices=startnode, return_predecessors=True)
+
+        if np.isinf(dists[endnode]):
+            raise Exception("The start and end of the thalweg are not connected by water")
+
+        # Walk back from the end to the start
+        path = [endnode]
+        while path[-1] != startnode:
+            path.append(predecessors[path[-1]])
+        path = np.array(path[::-1])
+
+        x, y = self.cellCenter(rows[path], cols[path])
+        # The raw path is a staircase. Knock the steps off at the scale of a cell
+        return LineString(np.column_stack((x, y))).simplify(self.cellSize)
@@ -1,60 +1,248 @@
 from logger import Logger
 import numpy as np
+from collections import OrderedDict
 from shapely.geos import TopologicalError
 from shapely.geometry import *
+from rays import RayCaster
 import math
 
-def calcXSMetrics(xs, rivershapeWithDonuts, dem, fStationInterval):
+# Every metric we can calculate, in the order they go into the output: name -> (function, input names).
+# Metric functions work on a whole batch of cross sections at once and hand back one value for each.
+# The inputs are either one of the base inputs below or an intermediate from INTERMEDIATES.
+#
+# Base inputs (see MetricBatch):
+#   endpoints:  (N, 2, 2) array with the start and end of each cross section
+#   rivershape: the river polygon with its donuts
+#   coords:     (M, 2) array of every station of every cross section
+#   elevations: (M,) masked array of the DEM value at each station
+#   offsets:    (N + 1,) array. The stations of cross section i are [offsets[i]:offsets[i + 1]]
+METRICS = OrderedDict()
+
+# Values more than one metric needs (depths etc.): name -> (function, input names)
+INTERMEDIATES = {}
+
+def metric(name, *inputs):
     """
-    Calculate metrics for a list of cross sections
-    :param xs: The cross section to generate metrics from
-    :param rivershapeWithDonuts: The original rivershape file with donuts
-    :param dem: Raster object
-    :param fStationInterval: some interval (float)
+    Decorator that adds a metric to METRICS
+    :param name: Name of the metric (and the output field)
+    :param inputs: Names of the inputs the function takes, in order
     :return:
     """
-    regularPoints = interpolateRasterAlongLine(xs.geometry, fStationInterval)
-    # Augment these points with values from the raster
-    ptsdict = lookupRasterValues(regularPoints, dem)
+    def register(func):
+        METRICS[name] = (func, inputs)
+        return func
+    return register
 
-    # Get the reference Elevation from the edges
-    refElev = getRefElev(ptsdict['values'])
+def intermediate(name, *inputs):
+    """
+    Decorator that adds a shared intermediate value to INTERMEDIATES
+    :param name: Name metrics use to ask for it
+    :param inputs: Names of the inputs the function takes, in order
+    :return:
+    """
+    def register(func):
+        INTERMEDIATES[name] = (func, inputs)
+        return func
+    return register
 
-    xsmXSLength = xs.geometry.length
-    xsmWetWidth = dryWidth(xs.geometry, rivershapeWithDonuts)
-    xsmDryWidth = xsmXSLength - xsmWetWidth
+class MetricBatch:
+    """
+    The inputs for the metrics of a batch of cross sections. Intermediates get worked out the first
+    time something asks for them and then reused, so the depth array (for instance) only gets
+    calculated once no matter how many metrics need it.
+    """
 
-    if refElev == 0:
-        xs.isValid = False
-        xsmMaxDepth = 0
-        xsmMeanDepth = 0
-        xsmW2MxDepth = 0
-        xsmW2AvDepth = 0
-    else:
-        # The depth array must be calculated
-        deptharr = refElev - ptsdict['values']
-
-        xsmMaxDepth = maxDepth(deptharr)
-        xsmMeanDepth = meanDepth(deptharr)
-
-        xsmW2MxDepth = xsmWetWidth / xsmMaxDepth if not xsmMaxDepth == 0.0 else 0.0
-        xsmW2AvDepth = xsmWetWidth / xsmMeanDepth if not xsmMeanDepth == 0.0 else 0.0
-
-    # Make sure that everything has a value
-    xs.metrics = {
-        "XSLength": metricSanitize(xsmXSLength),
-        "WetWidth": metricSanitize(xsmWetWidth),
-        "DryWidth": metricSanitize(xsmDryWidth),
-        "MaxDepth": metricSanitize(xsmMaxDepth),
-        "MeanDepth": metricSanitize(xsmMeanDepth),
-        "W2MxDepth": metricSanitize(xsmW2MxDepth),
-        "W2AvDepth": metricSanitize(xsmW2AvDepth),
-        "BFElev": metricSanitize(refElev),
-        "BFArea": 0,
-        "HRadius": 0,
-        "NumStat":0
-    }
-    return ptsdict
+    def __init__(self, endpoints, stations, rivershape, caster=None):
+        """
+        :param endpoints: (N, 2, 2) array with the start and end of each cross section
+        :param stations: dictionary with 'points', 'values' and 'offsets' (see sampleStations)
+        :param rivershape: The original rivershape with donuts
+        :param caster: RayCaster for rivershape if there's one already (indexing the boundary is the
+                       expensive part so it's worth sharing between batches)
+        """
+        self.values = {
+            'endpoints': endpoints,
+            'rivershape': rivershape,
+            'coords': stations['points'],
+            'elevations': np.ma.masked_invalid(stations['values']),
+            'offsets': stations['offsets']
+        }
+        if caster is not None:
+            self.values['caster'] = caster
+
+    def get(self, name):
+        """
+        :param name: Base input or intermediate name
+        :return: The value
+        """
+        if name not in self.values:
+            func, inputs = INTERMEDIATES[name]
+            self.values[name] = func(*[self.get(inputName) for inputName in inputs])
+        return self.values[name]
+
+def metricInputs(names=None):
+    """
+    Every input and intermediate a set of metrics needs, all the way down. Handy for only setting up
+    the expensive inputs (like the ray caster) when something is actually going to use them.
+    :param names: The metrics we want. None means all of METRICS.
+    :return: set of input names
+    """
+    if names is None:
+        names = METRICS.keys()
+    needed = set()
+    pending = [inputName for name in names for inputName in METRICS[name][1]]
+    while len(pending) > 0:
+        inputName = pending.pop()
+        if inputName not in needed:
+            needed.add(inputName)
+            if inputName in INTERMEDIATES:
+                pending += INTERMEDIATES[inputName][1]
+    return needed
+
+def calcMetrics(endpoints, stations, rivershapeWithDonuts, names=None, caster=None):
+    """
+    Calculate metrics for a batch of cross sections
+    :param endpoints: (N, 2, 2) array with the start and end of each cross section
+    :param stations: The sampled stations for those cross sections (see sampleStations)
+    :param rivershapeWithDonuts: The original rivershape file with donuts
+    :param names: The metrics we want. None means all of METRICS.
+    :param caster: RayCaster for rivershapeWithDonuts (we make one if it's needed and this is None)
+    :return: (metrics, valid) where metrics is an OrderedDict of {name: (N,) array} (in METRICS order)
+             and valid is an (N,) boolean array that's False where there is no reference elevation
+    """
+    if names is None:
+        names = METRICS.keys()
+    unknown = set(names) - set(METRICS.keys())
+    if len(unknown) > 0:
+        raise Exception("Unknown metric(s): {0}".format(", ".join(sorted(unknown))))
+
+    batch = MetricBatch(endpoints, stations, rivershapeWithDonuts, caster)
+
+    metrics = OrderedDict()
+    for name, (func, inputs) in METRICS.iteritems():
+        if name in names:
+            metrics[name] = metricsSanitize(func(*[batch.get(inputName) for inputName in inputs]))
+
+    return metrics, batch.get('refElev') != 0
+
+# --------------------------------------------------------
+# Intermediates
+# --------------------------------------------------------
+@intermediate('counts', 'offsets')
+def _counts(offsets):
+    return np.diff(offsets)
+
+@intermediate('xsLength', 'endpoints')
+def _xsLength(endpoints):
+    deltas = endpoints[:, 1] - endpoints[:, 0]
+    return np.sqrt(deltas[:, 0] * deltas[:, 0] + deltas[:, 1] * deltas[:, 1])
+
+@intermediate('caster', 'rivershape')
+def _caster(rivershape):
+    return RayCaster(rivershape)
+
+@intermediate('wetWidth', 'endpoints', 'caster')
+def _wetWidth(endpoints, caster):
+    # Same as dryWidth (which despite the name is the wet width) for every cross section at once
+    return caster.insideLengths(endpoints)
+
+@intermediate('refElev', 'elevations', 'offsets')
+def _refElev(elevations, offsets):
+    # Batch version of getRefElev: 0 if either end has no value
+    firsts = offsets[:-1]
+    lasts = offsets[1:] - 1
+    ends = np.ma.getdata(elevations)
+    refElev = (ends[firsts] + ends[lasts]) / 2
+    mask = np.ma.getmaskarray(elevations)
+    refElev[mask[firsts] | mask[lasts]] = 0
+    return refElev
+
+@intermediate('depths', 'elevations', 'refElev', 'counts')
+def _depths(elevations, refElev, counts):
+    # nan wherever the DEM has no value
+    return np.repeat(refElev, counts) - np.ma.filled(elevations.astype(refElev.dtype), np.nan)
+
+@intermediate('maxDepth', 'depths', 'offsets', 'refElev')
+def _maxDepth(depths, offsets, refElev):
+    # fmax skips over the nans just like maxDepth does
+    with np.errstate(invalid='ignore'):
+        return np.where(refElev != 0, np.fmax.reduceat(depths, offsets[:-1]), 0)
+
+@intermediate('meanDepth', 'depths', 'offsets', 'refElev')
+def _meanDepth(depths, offsets, refElev):
+    # Only the positive depths count (see meanDepth)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        positive = depths > 0
+        sums = np.add.reduceat(np.where(positive, depths, 0).astype(np.float64), offsets[:-1])
+        counts = np.add.reduceat(positive.astype(np.int64), offsets[:-1])
+        return np.where((refElev != 0) & (counts > 0), sums / counts, 0)
+
+@intermediate('hydraulics', 'coords', 'refElev', 'depths', 'offsets')
+def _hydraulics(coords, refElev, depths, offsets):
+    # BFArea, WetPerim and HRadius all come out of the same pass over the stretches
+    return hydraulicMetrics(coords, refElev, depths, offsets)
+
+# --------------------------------------------------------
+# Metrics
+# --------------------------------------------------------
+@metric('XSLength', 'xsLength')
+def _metricXSLength(xsLength):
+    return xsLength
+
+@metric('WetWidth', 'wetWidth')
+def _metricWetWidth(wetWidth):
+    return wetWidth
+
+@metric('DryWidth', 'xsLength', 'wetWidth')
+def _metricDryWidth(xsLength, wetWidth):
+    return xsLength - wetWidth
+
+@metric('MaxDepth', 'maxDepth')
+def _metricMaxDepth(maxDepth):
+    return maxDepth
+
+@metric('MeanDepth', 'meanDepth')
+def _metricMeanDepth(meanDepth):
+    return meanDepth
+
+@metric('W2MxDepth', 'wetWidth', 'maxDepth')
+def _metricW2MxDepth(wetWidth, maxDepth):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(maxDepth != 0, wetWidth / maxDepth, 0)
+
+@metric('W2AvDepth', 'wetWidth', 'meanDepth')
+def _metricW2AvDepth(wetWidth, meanDepth):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(meanDepth != 0, wetWidth / meanDepth, 0)
+
+@metric('BFElev', 'refElev')
+def _metricBFElev(refElev):
+    return refElev
+
+@metric('BFArea', 'hydraulics')
+def _metricBFArea(hydraulics):
+    return hydraulics['BFArea']
+
+@metric('WetPerim', 'hydraulics')
+def _metricWetPerim(hydraulics):
+    return hydraulics['WetPerim']
+
+@metric('HRadius', 'hydraulics')
+def _metricHRadius(hydraulics):
+    return hydraulics['HRadius']
+
+@metric('NumStat', 'counts')
+def _metricNumStat(counts):
+    return counts
+
+def metricsSanitize(values):
+    """
+    Batch version of metricSanitize
+    :param values: array of metric values
+    :return: float64 array (nan becomes 0)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    return np.where(np.isnan(values), 0.0, values)
 
 def metricSanitize(metric):
     """
@@ -154,4 +342,108 @@ def lookupRasterValues(points, raster):
     # Mask out the np.nan values
     pointsdict['values'] = np.ma.masked_invalid(pointsdict['values'])
 
-    return pointsdict
\ No newline at end of file
+    return pointsdict
+
+def interpolateStations(endpoints, fStationInterval):
+    """
+    Batch version of interpolateRasterAlongLine for straight cross sections. All the stations for all
+    the cross sections go into one ragged array: the stations for cross section i are
+    coords[offsets[i]:offsets[i + 1]]
+    :param endpoints: (N, 2, 2) array with the start and end of each cross section
+    :param fStationInterval:
+    :return: (coords, offsets) where coords is (M, 2) and offsets is (N + 1,)
+    """
+    starts = endpoints[:, 0]
+    deltas = endpoints[:, 1] - starts
+    lengths = np.sqrt(deltas[:, 0] * deltas[:, 0] + deltas[:, 1] * deltas[:, 1])
+
+    # Same number of points np.arange(0, length, fStationInterval) gives plus the endpoint
+    counts = np.ceil(lengths / fStationInterval).astype(np.int64) + 1
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    xsidx = np.repeat(np.arange(len(endpoints)), counts)
+    stationidx = np.arange(offsets[-1]) - offsets[xsidx]
+    # A zero length cross section only gets its endpoint. Don't divide by its length to get there.
+    fraction = np.zeros(len(xsidx))
+    np.divide(stationidx * fStationInterval, lengths[xsidx], out=fraction, where=lengths[xsidx] > 0)
+
+    coords = starts[xsidx] + deltas[xsidx] * fraction[:, np.newaxis]
+    # The last station is always the endpoint itself
+    coords[offsets[1:] - 1] = endpoints[:, 1]
+    return coords, offsets
+
+def sampleStations(endpoints, raster, fStationInterval, method='nearest'):
+    """
+    Lay out the stations for a whole bunch of cross sections and look them all up in the raster in one go
+    :param endpoints: (N, 2, 2) array with the start and end of each cross section
+    :param raster: Raster object
+    :param fStationInterval:
+    :param method: 'nearest' or 'bilinear' (see Raster.getPixelVals)
+    :return: dictionary with 'points' (M, 2), 'values' (M,) masked array and 'offsets' (N + 1,)
+    """
+    coords, offsets = interpolateStations(endpoints, fStationInterval)
+    return {
+        "points": coords,
+        "values": raster.getPixelVals(coords, method),
+        "offsets": offsets
+    }
+
+def hydraulicMetrics(coords, refElev, depths, offsets):
+    """
+    Bankfull area, wetted perimeter, hydraulic radius and station count for a whole batch of cross
+    sections at once. The stations come in as one ragged array (see interpolateStations): the stations
+    for cross section i are coords[offsets[i]:offsets[i + 1]].
+
+    The water surface is at BFElev (see getRefElev) and the bed is a straight line between stations so
+    a stretch that only partly dips below the surface only counts the part that does. Stretches that
+    touch a nodata station count as dry. Cross sections without a BFElev get zeros (apart from NumStat).
+    :param coords: (M, 2) array of station coordinates
+    :param refElev: (N,) array of BFElev for each cross section. 0 means there isn't one (the 'refElev' intermediate)
+    :param depths: (M,) array of depth below BFElev at each station. nan where there's no DEM value
+                   (the 'depths' intermediate)
+    :param offsets: (N + 1,) array
+    :return: dictionary of (N,) arrays: 'BFArea', 'WetPerim', 'HRadius' and 'NumStat'
+    """
+    counts = np.diff(offsets)
+    metrics = {
+        "BFArea": np.zeros(len(counts)),
+        "WetPerim": np.zeros(len(counts)),
+        "HRadius": np.zeros(len(counts)),
+        "NumStat": counts
+    }
+    if len(counts) == 0:
+        return metrics
+
+    firsts = offsets[:-1]
+    lasts = offsets[1:] - 1
+    hasRef = refElev != 0
+    depths = np.asarray(depths, dtype=np.float64)
+
+    # Stretch j runs from station j to station j + 1. The one that starts on the last station of a cross
+    # section would run into the next cross section so it gets zeroed below.
+    widths = np.hypot(*np.diff(coords, axis=0).T)
+    d0 = depths[:-1]
+    d1 = depths[1:]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        wet0 = np.maximum(d0, 0)
+        wet1 = np.maximum(d1, 0)
+        # How much of the stretch is under water (linear between the two stations)
+        wetFrac = np.where((d0 > 0) & (d1 > 0), 1.0,
+                           np.where((d0 > 0) | (d1 > 0), (wet0 + wet1) / np.abs(d0 - d1), 0.0))
+        area = widths * wetFrac * (wet0 + wet1) / 2
+        perim = np.hypot(widths, d1 - d0) * wetFrac
+
+    stretchArea = np.zeros(len(depths))
+    stretchPerim = np.zeros(len(depths))
+    stretchArea[:-1] = np.where(np.isnan(area), 0, area)
+    stretchPerim[:-1] = np.where(np.isnan(perim), 0, perim)
+    stretchArea[lasts] = 0
+    stretchPerim[lasts] = 0
+
+    bfArea = np.add.reduceat(stretchArea, firsts)
+    wetPerim = np.add.reduceat(stretchPerim, firsts)
+    metrics['BFArea'] = np.where(hasRef, bfArea, 0)
+    metrics['WetPerim'] = np.where(hasRef, wetPerim, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        metrics['HRadius'] = np.where(metrics['WetPerim'] > 0, metrics['BFArea'] / metrics['WetPerim'], 0)
+    return metrics
@@ -1,15 +1,50 @@
+import ctypes
 import gdal
+import hashlib
+import json
+import multiprocessing
+import os
 import numpy as np
+from collections import OrderedDict
 from logger import Logger
 # this allows GDAL to throw Python Exceptions
 gdal.UseExceptions()
 
 class Raster:
 
-    def __init__(self, sfilename):
+    # Size (in cells) of the square windows we read in lazy mode
+    BLOCK_SIZE = 256
+
+    # Cells of padding around the extent when we clip the band for the on-disk cache
+    CACHE_PAD = 2
+
+    lazy = False
+
+    def __init__(self, sfilename, cacheMB=0, cacheDir=None, extent=None):
+        """
+        :param sfilename: Path to the raster
+        :param cacheMB: 0 reads the whole band into memory right away. Anything else turns on lazy mode:
+                        we only read the blocks that getPixelVal(s) actually touch and keep at most this
+                        many MB of them around.
+        :param cacheDir: Keep a memory-mapped copy of the band (clipped to extent) in this folder. Later runs
+                         map it straight back in instead of decoding the raster again. Overrides cacheMB.
+        :param extent: (minx, miny, maxx, maxy) we need values for. Only used with cacheDir. None keeps
+                       the whole raster.
+        """
         self.log = Logger("Raster")
         self.filename = sfilename
 
+        if cacheDir is not None and not os.path.isfile(self.filename):
+            self.log.warning("Can only cache rasters that are a single file. Reading {0} directly.".format(self.filename))
+            cacheDir = None
+        self.lazy = cacheMB > 0 and cacheDir is None
+
+        if cacheDir is not None:
+            cachePaths = self._cachePaths(cacheDir)
+            if self._loadCache(cachePaths, extent):
+                self.log.info("Using the cached DEM: {0}".format(cachePaths[0]))
+                return
+
         self.errs = ""
         try:
             src_ds = gdal.Open( self.filename )
@@ -23,18 +58,31 @@ class Raster:
             self.driver = src_ds.GetDriver().LongName
             self.gt = src_ds.GetGeoTransform()
             self.nodata = srcband.GetNoDataValue()
-            """ Turn a Raster with a single band into a 2D [x,y] = v array """
-            self.array = srcband.ReadAsArray()
-
-            # Now mask out any NAN or nodata values (we do both for consistency)
-            if self.nodata is not None:
-                self.array = np.ma.array(self.array, mask=(np.isnan(self.array) | (self.array == self.nodata)))
-
             self.dataType = srcband.DataType
-            self.min = np.nanmin(self.array)
-            self.max = np.nanmax(self.array)
             self.proj = src_ds.GetProjection()
 
+            if self.lazy:
+                # Hang onto the dataset and read blocks as we need them. The min and max
+                # only get worked out if someone asks (see __getattr__)
+                self.array = None
+                self._ds = src_ds
+                self._band = srcband
+                self._pid = os.getpid()
+                self._cache = OrderedDict()
+                self._cacheBytes = 0
+                self._cacheLimit = cacheMB * 1024 * 1024
+                self._dtype = srcband.ReadAsArray(0, 0, 1, 1).dtype
+            elif cacheDir is None:
+                """ Turn a Raster with a single band into a 2D [x,y] = v array """
+                self.array = srcband.ReadAsArray()
+
+                # Now mask out any NAN or nodata values (we do both for consistency)
+                if self.nodata is not None:
+                    self.array = np.ma.array(self.array, mask=(np.isnan(self.array) | (self.array == self.nodata)))
+
+                self.min = np.nanmin(self.array)
+                self.max = np.nanmax(self.array)
+
             # Remember:
             # [0]/* top left x */
             # [1]/* w-e pixel resolution */
@@ -48,21 +96,55 @@ class Raster:
             self.cellHeight = self.gt[5]
             self.cols = src_ds.RasterXSize
             self.rows = src_ds.RasterYSize
-            # Important to throw away the srcband
-            srcband.FlushCache()
-            srcband = None
+
+            if cacheDir is not None:
+                self._buildCache(cachePaths, srcband, extent)
+
+            if not self.lazy:
+                # Important to throw away the srcband
+                srcband.FlushCache()
+                srcband = None
 
         except RuntimeError as e:
             self.log.error('Could not retrieve meta Data for %s' % self.filepath, e)
             raise e
 
+    def __getattr__(self, name):
+        # Lazy rasters work out their min and max the first time someone asks for them
+        if name in ['min', 'max'] and self.lazy:
+            self.min, self.max = self._band.ComputeRasterMinMax(False)
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def toSharedMemory(self):
+        """
+        Move the raster data into shared memory. Any process forked after this (a multiprocessing.Pool
+        for instance) reads the same block of memory instead of getting its own copy of the DEM.
+        :return:
+        """
+        if self.lazy:
+            # Nothing to share. Each process reads (and caches) just the blocks it needs.
+            return
+        if isinstance(self.array, np.memmap):
+            # Already shared: every process maps the same file and the OS keeps one copy of the pages
+            return
+        if isinstance(self.array, np.ma.MaskedArray):
+            self.array = np.ma.array(sharedArray(self.array.data), mask=sharedArray(np.ma.getmaskarray(self.array)))
+        else:
+            self.array = sharedArray(self.array)
+
     def getPixelVal(self, pt):
+        if self.lazy:
+            val = self.getPixelVals([pt])[0]
+            return np.nan if val is np.ma.masked else val
+
         # Convert from map to pixel coordinates.
         # Only works for geotransforms with no rotation.
-        px = int((pt[0] - self.left) / self.cellWidth)  # x pixel
-        py = int((pt[1] - self.top) / self.cellHeight)  # y pixel
+        px = int(np.floor((pt[0] - self.left) / self.cellWidth))  # x pixel
+        py = int(np.floor((pt[1] - self.top) / self.cellHeight))  # y pixel
 
-        if px < self.cols and py < self.rows:
+        # Negative indices are off the raster too (numpy would happily wrap them around)
+        if 0 <= px < self.cols and 0 <= py < self.rows:
             val = self.array[py, px]
         else:
             return np.nan
@@ -72,5 +154,369 @@ class Raster:
 
         return val
 
+    def getPixelVals(self, coords, method='nearest'):
+        """
+        Batch version of getPixelVal
+        :param coords: (N, 2) array of map coordinates
+        :param method: 'nearest' takes the value of the cell each point falls in. 'bilinear' interpolates
+                       between the four closest cell centers
+        :return: (N,) masked array with nodata and anything off the raster masked out
+        """
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        # Continuous pixel coordinates (0, 0 is the top left corner of the top left cell)
+        fx = (coords[:, 0] - self.left) / self.cellWidth
+        fy = (coords[:, 1] - self.top) / self.cellHeight
+
+        if method == 'nearest':
+            values, invalid = self._lookup(np.floor(fx).astype(np.int64), np.floor(fy).astype(np.int64))
+
+        elif method == 'bilinear':
+            inside = (fx >= 0) & (fx <= self.cols) & (fy >= 0) & (fy <= self.rows)
+
+            # Measure from the cell centers instead. Within half a cell of the edge we just use the edge cells
+            fx = np.clip(fx - 0.5, 0, self.cols - 1)
+            fy = np.clip(fy - 0.5, 0, self.rows - 1)
+            x0 = np.minimum(np.floor(fx).astype(np.int64), max(self.cols - 2, 0))
+            y0 = np.minimum(np.floor(fy).astype(np.int64), max(self.rows - 2, 0))
+            x1 = np.minimum(x0 + 1, self.cols - 1)
+            y1 = np.minimum(y0 + 1, self.rows - 1)
+            wx = fx - x0
+            wy = fy - y0
+
+            values = np.zeros(len(coords))
+            invalid = ~inside
+            for px, py, weight in [(x0, y0, (1 - wx) * (1 - wy)), (x1, y0, wx * (1 - wy)),
+                                   (x0, y1, (1 - wx) * wy), (x1, y1, wx * wy)]:
+                cornerVals, cornerInvalid = self._lookup(px, py)
+                # A bad cell only matters if it has some weight
+                invalid |= cornerInvalid & (weight > 0)
+                values += np.where(cornerInvalid, 0, cornerVals) * weight
+
+        else:
+            raise Exception("Unknown sampling method: {0}".format(method))
+
+        values[invalid] = np.nan
+        return np.ma.masked_invalid(values)
+
+    def _lookup(self, px, py):
+        """
+        Look up raster values at pixel indices
+        :param px: array of column indices
+        :param py: array of row indices
+        :return: (values, invalid) where invalid flags anything off the raster, masked, nan or nodata
+        """
+        # Keep the raster's own precision (so metrics come out the same as with getPixelVal)
+        # unless it can't hold a nan
+        rawtype = self._dtype if self.lazy else self.array.dtype
+        dtype = rawtype if np.issubdtype(rawtype, np.floating) else np.float64
+
+        inside = (px >= 0) & (px < self.cols) & (py >= 0) & (py < self.rows)
+        values = np.full(len(px), np.nan, dtype=dtype)
+        invalid = ~inside
+
+        if self.lazy:
+            # Group the cells by block so we only go to each block once
+            insideidx = np.flatnonzero(inside)
+            bx = px[insideidx] // self.BLOCK_SIZE
+            by = py[insideidx] // self.BLOCK_SIZE
+            blockKeys = by * (self.cols // self.BLOCK_SIZE + 1) + bx
+            order = np.argsort(blockKeys, kind='mergesort')
+            bounds = np.flatnonzero(np.diff(blockKeys[order])) + 1
+            for members in np.split(insideidx[order], bounds):
+                if len(members) == 0:
+                    continue
+                blockx = px[members[0]] // self.BLOCK_SIZE
+                blocky = py[members[0]] // self.BLOCK_SIZE
+                data, mask = self._getBlock(blockx, blocky)
+                rows = py[members] - blocky * self.BLOCK_SIZE
+                cols = px[members] - blockx * self.BLOCK_SIZE
+                values[members] = data[rows, cols]
+                invalid[members] = mask[rows, cols]
+        else:
+            data = np.ma.getdata(self.array)
+            values[inside] = data[py[inside], px[inside]]
+            # A memory-mapped cache has no mask (the nodata test below covers it)
+            mask = np.ma.getmask(self.array)
+            if mask is not np.ma.nomask:
+                invalid[inside] = mask[py[inside], px[inside]]
+
+        with np.errstate(invalid='ignore'):
+            invalid |= np.isnan(values)
+            if self.nodata is not None:
+                # Same test as isclose(val, self.nodata, rel_tol=1e-07)
+                invalid |= np.abs(values - self.nodata) <= 1e-07 * np.maximum(np.abs(values), abs(self.nodata))
+        return values, invalid
+
+    def _getBlock(self, blockx, blocky):
+        """
+        Get one block of the raster in lazy mode, reading it if it's not in the cache already
+        :param blockx: Block column
+        :param blocky: Block row
+        :return: (data, mask) 2D arrays for the block
+        """
+        # A forked worker can't share the GDAL dataset (or the file position underneath it)
+        # with its parent so it opens its own and starts a fresh cache
+        if os.getpid() != self._pid:
+            self._reopen()
+
+        key = (blockx, blocky)
+        if key in self._cache:
+            # Move it to the back of the line
+            block = self._cache.pop(key)
+            self._cache[key] = block
+            return block
+
+        xoff = blockx * self.BLOCK_SIZE
+        yoff = blocky * self.BLOCK_SIZE
+        data = self._readWindow(xoff, yoff, min(self.BLOCK_SIZE, self.cols - xoff), min(self.BLOCK_SIZE, self.rows - yoff))
+
+        # Same mask as the whole-band version
+        mask = np.zeros(data.shape, dtype=bool)
+        if self.nodata is not None:
+            mask = np.isnan(data) | (data == self.nodata)
+
+        block = (data, mask)
+        self._cache[key] = block
+        self._cacheBytes += data.nbytes + mask.nbytes
+
+        # Throw away the blocks we used least recently until we fit again (but always keep this one)
+        while self._cacheBytes > self._cacheLimit and len(self._cache) > 1:
+            oldKey, (oldData, oldMask) = self._cache.popitem(last=False)
+            self._cacheBytes -= oldData.nbytes + oldMask.nbytes
+
+        return block
+
+    def _readWindow(self, xoff, yoff, xsize, ysize):
+        """
+        Read a window of the band straight from the file
+        :return: 2D numpy array
+        """
+        return self._band.ReadAsArray(xoff, yoff, xsize, ysize)
+
+    def _reopen(self):
+        """
+        Open the dataset again (after a fork) and start with an empty cache
+        :return:
+        """
+        self._ds = gdal.Open(self.filename)
+        self._band = self._ds.GetRasterBand(1)
+        self._pid = os.getpid()
+        self._cache = OrderedDict()
+        self._cacheBytes = 0
+
+    def _cachePaths(self, cacheDir):
+        """
+        Where the cache for this raster lives. The name includes a hash of the full path so two
+        DEMs called dem.tif in different folders don't trample each other.
+        :param cacheDir: Cache folder
+        :return: (data path, sidecar path)
+        """
+        stem = "{0}_{1}".format(os.path.splitext(os.path.basename(self.filename))[0],
+                                hashlib.md5(os.path.abspath(self.filename)).hexdigest()[:8])
+        return os.path.join(cacheDir, stem + ".dat"), os.path.join(cacheDir, stem + ".json")
+
+    def _loadCache(self, cachePaths, extent):
+        """
+        Map a cache written by _buildCache back in
+        :param cachePaths: (data path, sidecar path)
+        :param extent: (minx, miny, maxx, maxy) we need values for (None for everything)
+        :return: True if the cache was good and this raster now reads from it. False if it's missing,
+                 stale (the source changed) or doesn't cover the extent.
+        """
+        dataPath, sidecarPath = cachePaths
+        meta = _readSidecar(sidecarPath)
+        if meta is None or not os.path.isfile(dataPath):
+            return False
+
+        if not _sourceMatches(self.filename, meta['source']):
+            self.log.info("{0} has changed since it was cached".format(self.filename))
+            return False
+
+        xoff, yoff, xsize, ysize = meta['window']
+        want = _extentWindow(meta['sourceGeoTransform'], meta['sourceCols'], meta['sourceRows'], extent, self.CACHE_PAD)
+        if want[2] > 0 and want[3] > 0 and (want[0] < xoff or want[1] < yoff or want[0] + want[2] > xoff + xsize
+                                            or want[1] + want[3] > yoff + ysize):
+            self.log.info("The cached DEM doesn't cover this extent")
+            return False
+
+        dtype = np.dtype(str(meta['dtype']))
+        if os.path.getsize(dataPath) != xsize * ysize * dtype.itemsize:
+            return False
+
+        self._applyCache(meta, np.memmap(dataPath, dtype=dtype, mode='r', shape=(ysize, xsize)))
+        return True
+
+    def _buildCache(self, cachePaths, srcband, extent):
+        """
+        Read the part of the band we need and write it out as a raw memory map with a JSON sidecar
+        (geotransform, nodata, source checksum etc.). Afterwards this raster reads from the cache
+        just like it would on a later run.
+        :param cachePaths: (data path, sidecar path)
+        :param srcband: Open GDAL band
+        :param extent: (minx, miny, maxx, maxy) we need values for (None for everything)
+        :return:
+        """
+        dataPath, sidecarPath = cachePaths
+        source = {
+            'path': os.path.abspath(self.filename),
+            'size': os.path.getsize(self.filename),
+            'mtime': os.path.getmtime(self.filename),
+            'md5': fileChecksum(self.filename)
+        }
+
+        window = _extentWindow(self.gt, self.cols, self.rows, extent, self.CACHE_PAD)
+        old = _readSidecar(sidecarPath)
+        if old is not None and old['source']['md5'] == source['md5']:
+            # Same file, different extent. Keep what we had too so flipping back and forth between
+            # two rivers doesn't rebuild the cache every time
+            x0 = min(window[0], old['window'][0])
+            y0 = min(window[1], old['window'][1])
+            x1 = max(window[0] + window[2], old['window'][0] + old['window'][2])
+            y1 = max(window[1] + window[3], old['window'][1] + old['window'][3])
+            window = (x0, y0, x1 - x0, y1 - y0)
+
+        if window[2] == 0 or window[3] == 0:
+            # Nothing we need is on the raster. Cache one cell so everything still lines up.
+            window = (0, 0, 1, 1)
+
+        arr = srcband.ReadAsArray(*window)
+        masked = arr if self.nodata is None else np.ma.array(arr, mask=(np.isnan(arr) | (arr == self.nodata)))
+        minval = np.nanmin(masked)
+        maxval = np.nanmax(masked)
+
+        meta = {
+            'source': source,
+            'sourceGeoTransform': list(self.gt),
+            'sourceCols': self.cols,
+            'sourceRows': self.rows,
+            'window': list(window),
+            'dtype': arr.dtype.str,
+            'nodata': self.nodata,
+            'min': None if minval is np.ma.masked else float(minval),
+            'max': None if maxval is np.ma.masked else float(maxval),
+            'bands': self.bands,
+            'driver': self.driver,
+            'dataType': self.dataType,
+            'proj': self.proj
+        }
+
+        try:
+            if not os.path.isdir(os.path.dirname(dataPath) or '.'):
+                os.makedirs(os.path.dirname(dataPath))
+            # Sidecar goes first and comes back last so there's never one pointing at a half written file
+            for path in cachePaths:
+                if os.path.exists(path):
+                    os.remove(path)
+            arr.tofile(dataPath + ".tmp")
+            os.rename(dataPath + ".tmp", dataPath)
+            with open(sidecarPath + ".tmp", 'w') as f:
+                json.dump(meta, f)
+            os.rename(sidecarPath + ".tmp", sidecarPath)
+        except (IOError, OSError) as e:
+            self.log.warning("Could not write the DEM cache to {0}: {1}".format(dataPath, e))
+            self._applyCache(meta, arr)
+            return
+
+        self.log.info("Cached the DEM to {0}".format(dataPath))
+        self._applyCache(meta, np.memmap(dataPath, dtype=arr.dtype, mode='r', shape=arr.shape))
+
+    def _applyCache(self, meta, array):
+        """
+        Set this raster up to read from a cached window of the original
+        :param meta: Sidecar dictionary
+        :param array: 2D array (usually a np.memmap) with the window
+        :return:
+        """
+        xoff, yoff, xsize, ysize = meta['window']
+        srcgt = meta['sourceGeoTransform']
+        self.gt = (srcgt[0] + xoff * srcgt[1] + yoff * srcgt[2], srcgt[1], srcgt[2],
+                   srcgt[3] + xoff * srcgt[4] + yoff * srcgt[5], srcgt[4], srcgt[5])
+        self.left = self.gt[0]
+        self.cellWidth = self.gt[1]
+        self.top = self.gt[3]
+        self.cellHeight = self.gt[5]
+        self.cols = xsize
+        self.rows = ysize
+
+        self.array = array
+        self.nodata = meta['nodata']
+        self.min = np.nan if meta['min'] is None else meta['min']
+        self.max = np.nan if meta['max'] is None else meta['max']
+        self.bands = meta['bands']
+        self.driver = meta['driver']
+        self.dataType = meta['dataType']
+        self.proj = meta['proj']
+        self.lazy = False
+
+def _extentWindow(gt, cols, rows, extent, pad):
+    """
+    The block of cells (plus some padding) that covers a map extent
+    :param gt: Geotransform
+    :param cols: Raster width
+    :param rows: Raster height
+    :param extent: (minx, miny, maxx, maxy) or None for the whole raster
+    :param pad: Cells to add on each side
+    :return: (xoff, yoff, xsize, ysize) clipped to the raster. The size is 0 if it's off the raster.
+    """
+    if extent is None:
+        return 0, 0, cols, rows
+    minx, miny, maxx, maxy = extent
+    xs = sorted([(minx - gt[0]) / gt[1], (maxx - gt[0]) / gt[1]])
+    ys = sorted([(miny - gt[3]) / gt[5], (maxy - gt[3]) / gt[5]])
+    x0 = min(max(int(np.floor(xs[0])) - pad, 0), cols)
+    y0 = min(max(int(np.floor(ys[0])) - pad, 0), rows)
+    x1 = max(min(int(np.ceil(xs[1])) + pad, cols), x0)
+    y1 = max(min(int(np.ceil(ys[1])) + pad, rows), y0)
+    return x0, y0, x1 - x0, y1 - y0
+
+def _readSidecar(sidecarPath):
+    """
+    :param sidecarPath: Path to the JSON sidecar of a DEM cache
+    :return: dictionary or None if there isn't one (or we can't read it)
+    """
+    try:
+        with open(sidecarPath, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+def _sourceMatches(filename, source):
+    """
+    Is this still the file we cached? Size and modification time are enough to say yes. If the time
+    changed (it got copied or touched) we fall back on the checksum.
+    :param filename: Path to the raster
+    :param source: 'source' dictionary from the sidecar
+    :return: bool
+    """
+    if os.path.getsize(filename) != source['size']:
+        return False
+    if os.path.getmtime(filename) == source['mtime']:
+        return True
+    return fileChecksum(filename) == source['md5']
+
+def fileChecksum(filename, blocksize=1024 * 1024):
+    """
+    MD5 of a file's contents
+    :param filename:
+    :param blocksize: How much to read at a time
+    :return: hex string
+    """
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(blocksize), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def sharedArray(arr):
+    """
+    Copy a numpy array into a block of shared memory
+    :param arr: numpy array
+    :return: numpy array with the same values backed by a multiprocessing.RawArray
+    """
+    shared = multiprocessing.RawArray(ctypes.c_char, max(arr.nbytes, 1))
+    newarr = np.frombuffer(shared, dtype=arr.dtype, count=arr.size).reshape(arr.shape)
+    newarr[...] = arr
+    return newarr
+
 def isclose(a, b, rel_tol=1e-09, abs_tol=0):
     return abs(a-b) <= max(rel_tol * max(abs(a), abs(b)), abs_tol)
\ No newline at end of file
@@ -0,0 +1,216 @@
+import itertools
+import numpy as np
+from scipy.spatial import cKDTree
+from shapely.geometry import *
+from shapely.vectorized import contains
+from logger import Logger
+from shapes import createNormalIntersect, getDiag
+
+
+class RayCaster:
+    """
+    Lay out cross sections by casting rays instead of intersecting lines with the river polygon.
+
+    All the boundary segments (exterior plus island rings) get indexed once. After that every station
+    casts a line along its normal against the segments near it and we keep the nearest hit on each
+    side. For a station inside the polygon that is exactly the piece of intersection that
+    createTangentialIntersect would have kept.
+    """
+
+    def __init__(self, rivershape):
+        """
+        Index the boundary segments of the river shape
+        :param rivershape: Polygon (or MultiPolygon) with qualifying islands as donuts
+        """
+        self.log = Logger('RayCaster')
+        self.rivershape = rivershape
+        self.diag = getDiag(rivershape)
+
+        polys = [rivershape] if rivershape.type == "Polygon" else list(rivershape)
+        rings = []
+        for poly in polys:
+            rings += [poly.exterior] + list(poly.interiors)
+
+        starts = []
+        ends = []
+        for ring in rings:
+            coords = np.array(ring.coords)[:, :2]
+            starts.append(coords[:-1])
+            ends.append(coords[1:])
+        self.starts = np.concatenate(starts)
+        self.deltas = np.concatenate(ends) - self.starts
+
+        # Any segment that comes within r of a point has its midpoint within r + segRadius of it
+        self.segTree = cKDTree(self.starts + self.deltas / 2)
+        self.segRadius = np.max(np.hypot(self.deltas[:, 0], self.deltas[:, 1])) / 2
+
+        # For a long thin channel area / perimeter is about half the width. Most rays hit
+        # something inside the width so that's where we start looking.
+        self.searchRadius = min(2 * rivershape.area / rivershape.length, self.diag)
+
+    def castCrossSections(self, stations, normals, chunksize=1000000):
+        """
+        Find the cross section for every station
+        :param stations: (N, 2) array of points on the centerline
+        :param normals: (N, 2) array of unit normals (see getStationNormals)
+        :param chunksize: Roughly how many station/segment pairs to work on at a time
+        :return: list of LineString (or None where there's no cross section)
+        """
+        stations = np.asarray(stations, dtype=np.float64).reshape(-1, 2)
+        normals = np.asarray(normals, dtype=np.float64).reshape(-1, 2)
+        xslines = [None] * len(stations)
+        if len(stations) == 0:
+            return xslines
+
+        # Stations on (or outside) the boundary are the odd ones out and there's only ever a handful
+        # of them (usually the ends of the centerline) so let the overlay sort those out.
+        inside = contains(self.rivershape, stations[:, 0], stations[:, 1])
+        for idx in np.flatnonzero(~inside):
+            xslines[idx] = createNormalIntersect(stations[idx], normals[idx], self.rivershape, self.diag)[0]
+
+        tplus = np.full(len(stations), np.inf)
+        tminus = np.full(len(stations), -np.inf)
+
+        # Look close by first. Any station whose nearest hit (on either side) is further away than
+        # we looked goes round again with a bigger radius.
+        pending = np.flatnonzero(inside)
+        radius = self.searchRadius
+        while len(pending) > 0:
+            lastPass = radius >= self.diag
+            candidates = self.segTree.query_ball_point(stations[pending], radius + self.segRadius)
+            counts = np.array([len(c) for c in candidates])
+
+            found = np.zeros(len(pending), dtype=bool)
+            # Chunk on station boundaries so we never hold more than about chunksize pairs at once
+            first = 0
+            while first < len(pending):
+                last = first + max(1, np.searchsorted(np.cumsum(counts[first:]), chunksize, side='right'))
+                chunkpairs = np.sum(counts[first:last])
+                if chunkpairs > 0:
+                    pairStation = np.repeat(np.arange(first, last), counts[first:last])
+                    pairSegment = np.fromiter(itertools.chain.from_iterable(candidates[first:last]),
+                                              dtype=np.int64, count=chunkpairs)
+                    chunkplus, chunkminus = self._nearestHits(stations[pending[pairStation]],
+                                                              normals[pending[pairStation]],
+                                                              pairSegment, pairStation - first, last - first)
+                    tplus[pending[first:last]] = chunkplus
+                    tminus[pending[first:last]] = chunkminus
+                    found[first:last] = (chunkplus <= radius) & (chunkminus >= -radius)
+                first = last
+
+            if lastPass:
+                break
+            pending = pending[~found]
+            radius = min(radius * 2, self.diag)
+
+        for idx in np.flatnonzero(inside):
+            if np.isfinite(tplus[idx]) and np.isfinite(tminus[idx]):
+                xslines[idx] = LineString([stations[idx] + tplus[idx] * normals[idx],
+                                           stations[idx] + tminus[idx] * normals[idx]])
+
+        return xslines
+
+    def insideLengths(self, endpoints, chunksize=10000):
+        """
+        How much of each straight segment lies inside the river shape. Batch version of summing up
+        segment.intersection(rivershape) that only ever looks at the boundary near each segment.
+
+        Every place a segment crosses the boundary splits it into pieces that are either all inside
+        or all outside, so we find the crossings and then test the middle of each piece.
+        :param endpoints: (N, 2, 2) array with the start and end of each segment
+        :param chunksize: How many segments to look for crossings on at once
+        :return: (N,) array of lengths
+        """
+        endpoints = np.asarray(endpoints, dtype=np.float64).reshape(-1, 2, 2)
+        starts = endpoints[:, 0]
+        deltas = endpoints[:, 1] - starts
+        lengths = np.hypot(deltas[:, 0], deltas[:, 1])
+        if len(endpoints) == 0:
+            return lengths
+
+        # Every segment gets split at 0 and 1 plus wherever it crosses the boundary
+        pieceIdx = [np.arange(len(endpoints)), np.arange(len(endpoints))]
+        pieceT = [np.zeros(len(endpoints)), np.ones(len(endpoints))]
+
+        mids = starts + deltas / 2
+        # Do the long ones last so the search radius only gets big for the chunks that need it
+        byLength = np.argsort(lengths, kind='mergesort')
+        for first in range(0, len(byLength), chunksize):
+            idx = byLength[first:first + chunksize]
+            candidates = self.segTree.query_ball_point(mids[idx], lengths[idx[-1]] / 2 + self.segRadius)
+            counts = np.array([len(c) for c in candidates])
+            if np.sum(counts) == 0:
+                continue
+            pairXS = np.repeat(idx, counts)
+            pairSeg = np.fromiter(itertools.chain.from_iterable(candidates), dtype=np.int64, count=np.sum(counts))
+
+            # Solve start + t * delta = segStart + u * segDelta
+            rel = self.starts[pairSeg] - starts[pairXS]
+            segDeltas = self.deltas[pairSeg]
+            xsDeltas = deltas[pairXS]
+            denom = xsDeltas[:, 0] * segDeltas[:, 1] - xsDeltas[:, 1] * segDeltas[:, 0]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = (rel[:, 0] * segDeltas[:, 1] - rel[:, 1] * segDeltas[:, 0]) / denom
+                u = (rel[:, 0] * xsDeltas[:, 1] - rel[:, 1] * xsDeltas[:, 0]) / denom
+                # Parallel segments (denom is 0) come out as nan or inf and drop out here
+                hit = (t > 0) & (t < 1) & (u >= 0) & (u <= 1)
+            pieceIdx.append(pairXS[hit])
+            pieceT.append(t[hit])
+
+        pieceIdx = np.concatenate(pieceIdx)
+        pieceT = np.concatenate(pieceT)
+        order = np.lexsort((pieceT, pieceIdx))
+        pieceIdx = pieceIdx[order]
+        pieceT = pieceT[order]
+
+        # The pieces run between neighbouring splits on the same segment
+        same = (pieceIdx[1:] == pieceIdx[:-1]) & (pieceT[1:] > pieceT[:-1])
+        xsIdx = pieceIdx[:-1][same]
+        tMid = (pieceT[:-1][same] + pieceT[1:][same]) / 2
+        dt = pieceT[1:][same] - pieceT[:-1][same]
+
+        midPts = starts[xsIdx] + deltas[xsIdx] * tMid[:, np.newaxis]
+        inside = contains(self.rivershape, midPts[:, 0], midPts[:, 1])
+        return np.bincount(xsIdx[inside], weights=dt[inside] * lengths[xsIdx[inside]], minlength=len(endpoints))
+
+    def _nearestHits(self, pts, normals, segments, groups, numGroups):
+        """
+        Cast a line through each point along its normal and find the closest crossing on each side.
+        Everything comes in as flat station/segment pairs.
+        :param pts: (n, 2) array with the station for each pair
+        :param normals: (n, 2) array with the normal for each pair
+        :param segments: (n,) index of the boundary segment for each pair
+        :param groups: (n,) which station (0 to numGroups - 1) each pair belongs to. Must be sorted.
+        :param numGroups: number of stations
+        :return: (tplus, tminus) distances along the normal to the nearest crossing on the positive
+                 side and the negative side (tminus is negative)
+        """
+        starts = self.starts[segments]
+        deltas = self.deltas[segments]
+
+        # Which side of the line each segment end sits on
+        relA = starts - pts
+        sideA = normals[:, 0] * relA[:, 1] - normals[:, 1] * relA[:, 0]
+        sideB = sideA + normals[:, 0] * deltas[:, 1] - normals[:, 1] * deltas[:, 0]
+
+        # A segment that only touches the line at one end still counts. That's what the overlay does:
+        # it splits the line at every boundary vertex it touches, so a spike of bank that just grazes
+        # the line stops the cross section whichever side the spike comes from. A line straight through
+        # a vertex hits both segments that share it at the same spot, which is harmless.
+        crosses = ((sideA >= 0) & (sideB <= 0)) | ((sideA <= 0) & (sideB >= 0))
+
+        # Segments that lie along the line come out as nan. Their neighbours touch the line at the
+        # same vertices so we drop them.
+        crosses &= (sideA != 0) | (sideB != 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            frac = sideA / (sideA - sideB)
+            t = (relA[:, 0] + frac * deltas[:, 0]) * normals[:, 0] + (relA[:, 1] + frac * deltas[:, 1]) * normals[:, 1]
+            plus = np.where(crosses & (t > 0), t, np.inf)
+            minus = np.where(crosses & (t < 0), t, -np.inf)
+
+        tplus = np.full(numGroups, np.inf)
+        tminus = np.full(numGroups, -np.inf)
+        groupStarts = np.flatnonzero(np.concatenate(([True], groups[1:] != groups[:-1])))
+        tplus[groups[groupStarts]] = np.minimum.reduceat(plus, groupStarts)
+        tminus[groups[groupStarts]] = np.maximum.reduceat(minus, groupStarts)
+        return tplus, tminus
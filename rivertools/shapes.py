@@ -3,6 +3,8 @@ import json
 import os
 import ogr
 import numpy as np
+from scipy.spatial import cKDTree
+from shapely.vectorized import contains
 from logger import Logger
 from shapely.geometry import *
 
@@ -43,10 +45,44 @@ class Shapefile:
         :param ogrOFT:
         :return:
         """
-        self.log.info("Creating field: {0}".format(fieldName))
+        # Debug only: every info message rewrites the whole XML log
+        self.log.debug("Creating field: {0}".format(fieldName))
         aField = ogr.FieldDefn(fieldName, ogrOFT)
         self.layer.CreateField(aField)
 
+    def writeFeatures(self, geometries, fields=None, constants=None):
+        """
+        Write a whole lot of features at once. We reuse a single feature for all of them so the
+        constant fields only get set once. NB: Shapefiles don't do transactions so there's nothing
+        to batch up. Any error from OGR comes straight out.
+        :param geometries: list of WKB strings, or a coordinate array to pack into WKB: (N, 2) for
+                           points or (N, M, 2) for lines with M vertices each (see coordsToWKB)
+        :param fields: {name: column} where each column (list or array) has a value for every feature
+        :param constants: {name: value} for the fields that are the same on every feature
+        :return:
+        """
+        if isinstance(geometries, np.ndarray):
+            geometries = coordsToWKB(geometries)
+        fields = {} if fields is None else fields
+        constants = {} if constants is None else constants
+
+        featureDefn = self.layer.GetLayerDefn()
+        outFeature = ogr.Feature(featureDefn)
+        for fieldName, value in constants.iteritems():
+            outFeature.SetField(fieldName, value)
+
+        # Look the field indexes up once and hand OGR plain Python values
+        columns = [(featureDefn.GetFieldIndex(fieldName), column.tolist() if isinstance(column, np.ndarray) else column)
+                   for fieldName, column in fields.iteritems()]
+
+        for idx in range(len(geometries)):
+            outFeature.SetGeometryDirectly(ogr.CreateGeometryFromWkb(geometries[idx]))
+            for fieldIdx, column in columns:
+                outFeature.SetField(fieldIdx, column[idx])
+            # Let the layer hand out a new FID every time
+            outFeature.SetFID(-1)
+            self.layer.CreateFeature(outFeature)
+
     def featuresToShapely(self):
         if len(self.features) == 0:
             return []
@@ -93,18 +129,199 @@ class Shapefile:
             #     if self.datasource.Destroy:
             #         self.datasource.Destroy()
 
-class RiverPoint:
+class RiverPoints:
+    """
+    Every point we feed into the Voronoi. Rather than one Python object per vertex
+    we hold everything in flat arrays that line up with each other:
+
+        coords:   (N, 2) float64 point coordinates
+        side:     (N,) int8 which side of the thalweg the point is on (1 or -1)
+        interior: (N,) bool True if the point is on an island
+        island:   (N,) int32 index of the island the point is on (-1 for the banks)
+    """
+
+    def __init__(self, coords, side=None, interior=None, island=None):
+        self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        count = len(self.coords)
+        self.side = np.ones(count, dtype=np.int8) if side is None else np.asarray(side, dtype=np.int8)
+        self.interior = np.zeros(count, dtype=bool) if interior is None else np.asarray(interior, dtype=bool)
+        self.island = np.full(count, -1, dtype=np.int32) if island is None else np.asarray(island, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.coords)
+
+    def subset(self, idx):
+        """
+        Pull out some of the points
+        :param idx: index array or boolean mask
+        :return: RiverPoints
+        """
+        return RiverPoints(self.coords[idx], self.side[idx], self.interior[idx], self.island[idx])
+
+    @staticmethod
+    def concatenate(pointsets):
+        """
+        Join several sets of points together into one
+        :param pointsets: list of RiverPoints
+        :return: RiverPoints
+        """
+        return RiverPoints(np.concatenate([pts.coords for pts in pointsets]),
+                           np.concatenate([pts.side for pts in pointsets]),
+                           np.concatenate([pts.interior for pts in pointsets]),
+                           np.concatenate([pts.island for pts in pointsets]))
+
+def coordsToWKB(coords):
+    """
+    Pack coordinate arrays straight into (little endian) WKB without going through shapely or JSON
+    :param coords: (N, 2) array for points or (N, M, 2) array for lines that all have M vertices
+    :return: list of N WKB strings
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    if coords.ndim == 2:
+        wkbType = np.dtype([('order', 'u1'), ('type', '<u4'), ('coords', '<f8', (2,))])
+        wkb = np.empty(len(coords), dtype=wkbType)
+        wkb['type'] = ogr.wkbPoint
+    else:
+        wkbType = np.dtype([('order', 'u1'), ('type', '<u4'), ('count', '<u4'), ('coords', '<f8', coords.shape[1:])])
+        wkb = np.empty(len(coords), dtype=wkbType)
+        wkb['type'] = ogr.wkbLineString
+        wkb['count'] = coords.shape[1]
+    wkb['order'] = 1
+    wkb['coords'] = coords
+
+    raw = wkb.tobytes()
+    size = wkbType.itemsize
+    return [raw[idx * size:(idx + 1) * size] for idx in range(len(coords))]
+
+def getRiverPoints(shape, bankshape):
+    """
+    Turn every vertex of the river shape into a point and assign it to a side of the channel
+    :param shape: The (densified) river polygon. Interiors are qualifying islands
+    :param bankshape: Polygon of one of the banks. Points inside it are side 1, everything else is -1
+    :return: RiverPoints
+    """
+    # Exterior is the shell and there is only ever 1. It gets island -1
+    # NB: Interiors are only qualifying islands in this case
+    rings = [np.asarray(ring.coords)[:, :2] for ring in [shape.exterior] + list(shape.interiors)]
+    island = np.concatenate([np.full(len(ring), idx - 1, dtype=np.int32) for idx, ring in enumerate(rings)])
+    coords = np.concatenate(rings)
+
+    side = np.where(contains(bankshape, coords[:, 0], coords[:, 1]), 1, -1)
+
+    return RiverPoints(coords, side=side, interior=island >= 0, island=island)
 
-    def __init__(self, pt, interior=False, side=None, island=None):
-        self.point = pt
-        self.side = side
-        self.interior = interior
-        self.island = island
+def getCorridorPoints(coarsePoints, finePoints, coarseLines, spacing, tolerance):
+    """
+    Mix coarse and fine points so that we only pay for dense points where they shape the centerline.
+
+    Where the banks run parallel and straight the coarse points already put the centerline in the right
+    place, so we only need fine points where the coarse centerline is not to be trusted: where it bends
+    sharply for the width of the channel, where the channel gets wider or narrower quickly, or where the
+    channel is so narrow that the coarse spacing can't resolve it. Fine points near those bits of
+    centerline are kept and the coarse points stand in everywhere else.
+    :param coarsePoints: RiverPoints from the coarse densification
+    :param finePoints: RiverPoints from the fine densification
+    :param coarseLines: list of coarse centerlines (main and side channel)
+    :param spacing: the coarse spacing. We sample the coarse lines at this interval
+    :param tolerance: how much bend (curvature x half-width) or width gradient we put up with before
+                      we go back to the fine points. Also the fraction of the bank distance added to the corridor
+    :return: RiverPoints
+    """
+    coarseXY = coarsePoints.coords
+    fineXY = finePoints.coords
+    bankTree = cKDTree(coarseXY)
+
+    samples = []
+    needsFine = []
+    for line in coarseLines:
+        for part in ([line] if line.type == "LineString" else list(line)):
+            coords = np.array(part.coords)
+            cumlength = np.concatenate(([0], np.cumsum(np.hypot(*np.diff(coords, axis=0).T))))
+            dists = np.append(np.arange(0, cumlength[-1], spacing), cumlength[-1])
+            partXY = np.column_stack((np.interp(dists, cumlength, coords[:, 0]),
+                                      np.interp(dists, cumlength, coords[:, 1])))
+            samples.append(partXY)
+            needsFine.append(_corridorNeedsFine(partXY, dists, bankTree.query(partXY)[0], spacing, tolerance))
+    samples = np.concatenate(samples)
+    needsFine = np.concatenate(needsFine)
+
+    if not np.any(needsFine):
+        return coarsePoints
+
+    # Only the samples that need help get a corridor of fine points
+    samples = samples[needsFine]
+    radius = bankTree.query(samples)[0]
+    reach = radius * (1 + tolerance) + spacing
+
+    sampleTree = cKDTree(samples)
+    fineDist, fineNearest = sampleTree.query(fineXY)
+    coarseDist, coarseNearest = sampleTree.query(coarseXY)
+
+    keepFine = np.flatnonzero(fineDist <= reach[fineNearest])
+    keepCoarse = np.flatnonzero(coarseDist > reach[coarseNearest])
+
+    return RiverPoints.concatenate([finePoints.subset(keepFine), coarsePoints.subset(keepCoarse)])
+
+def _corridorNeedsFine(samples, dists, radius, spacing, tolerance):
+    """
+    Flag the samples along one coarse centerline where the coarse points can't be trusted
+    :param samples: (N, 2) array of points along the line
+    :param dists: distance along the line of each sample
+    :param radius: distance from each sample to the nearest bank
+    :param spacing: the coarse spacing
+    :param tolerance: see getCorridorPoints
+    :return: boolean array, one per sample
+    """
+    count = len(samples)
+    # The coarse line wiggles on the scale of the coarse spacing, so we look at it over a
+    # window about as long as the channel is wide
+    window = np.clip(np.round(radius / spacing).astype(int), 1, None)
+    idx = np.arange(count)
+    before = np.clip(idx - window, 0, count - 1)
+    after = np.clip(idx + window, 0, count - 1)
+
+    inVec = samples - samples[before]
+    outVec = samples[after] - samples
+    turn = np.abs(np.arctan2(inVec[:, 0] * outVec[:, 1] - inVec[:, 1] * outVec[:, 0],
+                             np.einsum('ij,ij->i', inVec, outVec)))
+    span = dists[after] - dists[before]
+    span[span == 0] = 1.0
+
+    bend = 2 * turn / span * radius
+    gradient = np.abs(radius[after] - radius[before]) / span
+
+    needsFine = (bend > tolerance) | (gradient > tolerance) | (radius < spacing)
+    # The ends are where the line forks out to the corners of the banks (or joins another channel)
+    needsFine[[0, -1]] = True
+    return needsFine
 
 def createTangentialIntersect(dist, centerline, rivershape):
     diag = getDiag(rivershape)
     xsLong, point = createTangentialLine(dist, centerline, diag)
+    return _chooseCrossSection(xsLong, point, rivershape)
+
+def createNormalIntersect(station, normal, rivershape, length):
+    """
+    Same as createTangentialIntersect but for a station and normal we already know
+    (see getStationNormals)
+    :param station: (x, y) of the point on the centerline
+    :param normal: (x, y) unit normal to the centerline at that point
+    :param rivershape:
+    :param length: how far to extend the line on each side before we intersect (usually getDiag(rivershape))
+    :return: keepXs, throwaway, point just like createTangentialIntersect
+    """
+    xsLong = LineString([(station[0] + length * normal[0], station[1] + length * normal[1]),
+                         (station[0] - length * normal[0], station[1] - length * normal[1])])
+    return _chooseCrossSection(xsLong, Point(station), rivershape)
 
+def _chooseCrossSection(xsLong, point, rivershape):
+    """
+    Intersect a long cross section with the rivershape and keep the piece that contains our point
+    :param xsLong:
+    :param point:
+    :param rivershape:
+    :return: keepXs, throwaway, point
+    """
     # intersect the long crossection with the rivershape and see what falls out.
     intersections = rivershape.intersection(xsLong)
 
@@ -132,6 +349,37 @@ def createTangentialIntersect(dist, centerline, rivershape):
     # One point can only ever have one line segment
     return keepXs, throwaway, point
 
+def getStationNormals(centerline, distances):
+    """
+    Batch version of createTangentialLine. Find the points at a whole list of distances down the
+    centerline and the unit normals there, all in one go.
+
+    Like createTangentialLine, a station that sits exactly on a vertex takes the direction of the
+    segment before it and the normals point the same way (to the right of the line).
+    :param centerline: LineString
+    :param distances: array of distances along the line (e.g. np.arange(0, length, separation))
+    :return: (points, normals) as (N, 2) arrays
+    """
+    coords = np.array(centerline.coords)[:, :2]
+    # Zero-length segments have no direction so get rid of them first
+    seglengths = np.hypot(*np.diff(coords, axis=0).T)
+    coords = coords[np.concatenate(([True], seglengths > 0))]
+
+    deltas = np.diff(coords, axis=0)
+    seglengths = np.hypot(deltas[:, 0], deltas[:, 1])
+    cumlength = np.concatenate(([0], np.cumsum(seglengths)))
+
+    distances = np.asarray(distances, dtype=np.float64)
+    segidx = np.clip(np.searchsorted(cumlength, distances, side='left') - 1, 0, len(deltas) - 1)
+
+    frac = (distances - cumlength[segidx]) / seglengths[segidx]
+    points = coords[segidx] + deltas[segidx] * frac[:, np.newaxis]
+
+    tangents = deltas[segidx] / seglengths[segidx, np.newaxis]
+    normals = np.column_stack((tangents[:, 1], -tangents[:, 0]))
+
+    return points, normals
+
 def createTangentialLine(dist, centerline, length):
     """
     Create a tangential line at distance
@@ -332,53 +580,66 @@ def getExtrapoledLine(line, length):
 
 def densifyShape(shape, spacing):
     """
-    Densifies a shape (including
+    Densifies a shape (including its interiors)
     :param shape:
     :param spacing: the spacing between points
     :return:
     """
-    ext = _densifyRing(shape.exterior, spacing)
-
-    isls = []
-    for isl in shape.interiors:
-        isls.append(_densifyRing(isl, spacing))
-
-    if len(isls) == 0:
-        return ext
+    ext = _densifyCoords(shape.exterior.coords, spacing)
+    isls = [_densifyCoords(isl.coords, spacing) for isl in shape.interiors]
+
+    # Densifying only adds points along existing edges so the rings are almost always still valid
+    # and we can skip the (expensive) boolean difference
+    densePoly = Polygon(ext, isls)
+    if len(isls) == 0 or densePoly.is_valid:
+        return densePoly
     else:
-        return ext.difference(MultiPolygon(isls))
+        return Polygon(ext).difference(MultiPolygon([Polygon(isl) for isl in isls]))
 
 def _densifyRing(ring, spacing):
     """
-    Densify this particular ring using _densify segment on each segment
+    Densify this particular ring
     :param ring:
     :param spacing:
     :return:
     """
-    # Densify all the line segments. This return a list with the first point and any linear interpolated points
-    densesegments = [_densifySegment(LineString([ring.coords[x-1], ring.coords[x]]), spacing) for x in range(1, len(ring.coords))]
-    # Finally add the very last point to complete the ring
-    densesegments.append([ring.coords[-1]])
-    poly = Polygon(LinearRing([pt for seg in densesegments for pt in seg]))
-    return poly
-
+    return Polygon(LinearRing(_densifyCoords(ring.coords, spacing)))
 
 def _densifySegment(segment, spacing):
     """
     A segment is defined as a LineString with two points in it. Spacing is the point spacing we want.
     :param segment:
     :param spacing:
-    :return:
+    :return: list with the first point and any linear interpolated points (not the last point)
     """
-    if segment.length < spacing:
-        return [segment.coords[0]]
+    return [tuple(pt) for pt in _densifyCoords(segment.coords, spacing)[:-1]]
 
-    pts = []
-    for currDist in np.arange(0, segment.length, spacing):
-        newpt = segment.interpolate(currDist).coords[0]
-        if newpt != segment.coords[-1]:
-            pts.append(newpt)
-    return pts
+def _densifyCoords(coords, spacing):
+    """
+    Densify a list of coordinates all at once. Every segment gets the same points that
+    np.arange(0, segment.length, spacing) would give it (always at least its first point)
+    and then we add the very last point to close things off.
+    :param coords: list of (x, y) tuples or an (N, 2) array
+    :param spacing: the spacing between points
+    :return: (M, 2) numpy array
+    """
+    coords = np.asarray(coords, dtype=np.float64)[:, :2]
+    starts = coords[:-1]
+    deltas = np.diff(coords, axis=0)
+    lengths = np.hypot(deltas[:, 0], deltas[:, 1])
+
+    counts = np.maximum(np.ceil(lengths / spacing), 1).astype(np.int64)
+    segidx = np.repeat(np.arange(len(starts)), counts)
+    # Position of each new point within its own segment: 0, 1, 2... restarting for every segment
+    stepidx = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    seglengths = lengths[segidx]
+    frac = np.where(seglengths > 0, stepidx * spacing / np.where(seglengths > 0, seglengths, 1), 0)
+    # Floating point can land us right on the end of the segment. That point belongs to the next segment
+    keep = frac < 1
+    dense = starts[segidx[keep]] + deltas[segidx[keep]] * frac[keep, np.newaxis]
+
+    return np.concatenate((dense, coords[-1:]))
 
 def reconnectLine(baseline, separateLine):
     """
@@ -0,0 +1,206 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from shapely.geometry import *
+from shapely.vectorized import contains
+from shapely.ops import split
+from logger import Logger
+from vor import NARVoronoi
+
+# How far apart (in m) the ends of two neighbouring tile cores can be before we refuse to stitch them
+STITCH_TOLERANCE = 0.01
+
+
+def getTileWindows(length, tileSize, overlap):
+    """
+    Cut a distance range [0, length] into tiles. Each tile has a core (the part of the line it is
+    responsible for) and a window that extends the core by the overlap on both sides.
+
+    for example:
+        getTileWindows(250, 100, 10) returns
+            [(0, 110, 0, 100), (90, 210, 100, 200), (190, 250, 200, 250)]
+    :param length: Total length of the line we are tiling
+    :param tileSize: Length of each core
+    :param overlap: How far each window reaches into its neighbours
+    :return: list of (windowStart, windowEnd, coreStart, coreEnd) tuples
+    """
+    windows = []
+    for coreStart in np.arange(0, length, tileSize):
+        coreEnd = min(coreStart + tileSize, length)
+        windows.append((max(coreStart - overlap, 0), min(coreEnd + overlap, length), coreStart, coreEnd))
+    return windows
+
+
+def lineSubstring(line, start, end):
+    """
+    Return the part of a line between two distances along it
+    :param line: LineString
+    :param start: distance along the line to start at
+    :param end: distance along the line to stop at
+    :return: LineString
+    """
+    coords = np.array(line.coords)
+    cumlength = np.concatenate(([0], np.cumsum(np.hypot(*np.diff(coords, axis=0).T))))
+    inside = coords[(cumlength > start) & (cumlength < end)]
+
+    startpt = line.interpolate(start).coords[0]
+    endpt = line.interpolate(end).coords[0]
+    return LineString([startpt] + [tuple(c) for c in inside] + [endpt])
+
+
+def tiledCenterline(points, thalweg, rivershape, tileSize, overlap):
+    """
+    Calculate the centerline one window at a time so that we only ever hold the Voronoi diagram
+    for a single window in memory. The windows follow the thalweg and overlap each other so that
+    the part of each window's centerline that we keep (the core) is never near a cut edge.
+
+    :param points: RiverPoints (already assigned to a side)
+    :param thalweg: The thalweg, extended out to the river bounds
+    :param rivershape: The river shape (with qualifying islands as donuts)
+    :param tileSize: Length of each tile along the thalweg
+    :param overlap: How far each tile reaches into its neighbours
+    :return: (centerline, altLines) where altLines is a dictionary of {island index: side-channel line}
+             just like NARVoronoi.collectAlternateLines()
+    """
+    log = Logger("Tiled Centerline")
+
+    coords = points.coords
+    boundary = Polygon(rivershape.exterior)
+    windows = getTileWindows(thalweg.length, tileSize, overlap)
+
+    # Where along the thalweg each bank point is and how far from it. A bank point can shape the
+    # centerline about as far along the thalweg as it is from it, so each window has to be wide enough
+    # to hold every point whose reach overlaps it. That way one wide spot only makes the windows
+    # near it bigger.
+    step = min(tileSize, overlap if overlap > 0 else tileSize) / 4.0
+    samplesDist = np.append(np.arange(0, thalweg.length, step), thalweg.length)
+    samples = np.array([thalweg.interpolate(dist).coords[0] for dist in samplesDist])
+    pointOffset, nearest = cKDTree(samples).query(coords)
+    pointDist = samplesDist[nearest]
+    maxOffset = np.max(pointOffset)
+    byDist = np.argsort(pointDist, kind='mergesort')
+    sortedDist = pointDist[byDist]
+
+    # Sorting by x means each window only has to run contains() on the points inside its bounds
+    byX = np.argsort(coords[:, 0], kind='mergesort')
+    sortedX = coords[byX, 0]
+
+    # Neighbouring tiles cut their centerlines at the same line across the thalweg so the pieces
+    # meet exactly. The cut lines don't cost anything to make long enough for the widest spot.
+    cutLength = 2 * maxOffset + step + overlap
+    cuts = [_cutLine(thalweg, window[2], cutLength, step) for window in windows[1:]]
+
+    # Each island gets calculated in the tile whose core holds its centroid
+    islandTiles = {}
+    for idx, island in enumerate(rivershape.interiors):
+        islDist = thalweg.project(Polygon(island).centroid)
+        for tileIdx, window in enumerate(windows):
+            if window[2] <= islDist <= window[3]:
+                islandTiles[idx] = tileIdx
+                break
+
+    pieces = []
+    altLines = {}
+    for tileIdx, (start, end, coreStart, coreEnd) in enumerate(windows):
+        log.info("  Tile {0} of {1}: {2:.1f}m - {3:.1f}m".format(tileIdx + 1, len(windows), coreStart, coreEnd))
+        near = byDist[np.searchsorted(sortedDist, start - maxOffset - step, side='left'):
+                      np.searchsorted(sortedDist, end + maxOffset + step, side='right')]
+        along = np.maximum(np.maximum(start - pointDist[near], pointDist[near] - end), 0)
+        reaches = pointOffset[near] + step >= along
+        if np.sum(reaches) < 4:
+            continue
+        radius = np.max(pointOffset[near][reaches] + along[reaches]) + step + overlap
+        window = lineSubstring(thalweg, start, end).buffer(radius)
+
+        minx, miny, maxx, maxy = window.bounds
+        candidates = byX[np.searchsorted(sortedX, minx, side='left'):np.searchsorted(sortedX, maxx, side='right')]
+        candidates = candidates[(coords[candidates, 1] >= miny) & (coords[candidates, 1] <= maxy)]
+        inWindow = np.sort(candidates[contains(window, coords[candidates, 0], coords[candidates, 1])])
+        if len(inWindow) < 4:
+            continue
+
+        tileVor = NARVoronoi(points.subset(inWindow))
+        tileLine = tileVor.collectCenterLines(boundary)
+        # The cut at the start of our core (if there is one) and the one at the end. We keep what's
+        # downstream of the first and upstream of the second.
+        tileCuts = [(cuts[tileIdx - 1], 1)] if tileIdx > 0 else []
+        tileCuts += [(cuts[tileIdx], -1)] if tileIdx < len(cuts) else []
+        if len(tileCuts) > 0:
+            tileLine = split(tileLine, MultiLineString([cut[0] for cut, side in tileCuts]))
+
+        for piece in _lineParts(tileLine):
+            # Only keep what belongs to our core. The centerline can wander a long way off the
+            # thalweg (into a bay for instance) so we go by the cuts, not by where it projects.
+            # Long cut lines across tight meanders can chop up another limb of the river too but that
+            # bit is nowhere near our window along the thalweg.
+            midpt = np.array(piece.interpolate(0.5, normalized=True).coords[0])
+            if any([side * np.dot(midpt - center, tangent) < 0 for (cut, center, tangent), side in tileCuts]):
+                continue
+            middist = thalweg.project(Point(midpt))
+            if not start <= middist <= end:
+                continue
+            startdist = thalweg.project(Point(piece.coords[0]))
+            enddist = thalweg.project(Point(piece.coords[-1]))
+            if enddist < startdist:
+                piece = LineString(piece.coords[::-1])
+            pieces.append((min(startdist, enddist), piece))
+
+        tileIslands = [idx for idx, tile in islandTiles.items() if tile == tileIdx]
+        if len(tileIslands) > 0:
+            tileAltLines = tileVor.collectAlternateLines()
+            for idx in tileIslands:
+                if not window.contains(Polygon(rivershape.interiors[idx])):
+                    log.warning("Island {0} does not fit inside a single tile. Try a bigger --tileoverlap".format(idx))
+                elif idx in tileAltLines:
+                    altLines[idx] = tileAltLines[idx]
+
+        tileVor = None
+
+    if len(pieces) == 0:
+        raise Exception("No centerline found in any of the tiles")
+
+    # Stitch the cores back together in order down the thalweg. Each piece has to pick up where the
+    # last one left off. If it doesn't the tiles disagree about where the centerline goes (usually
+    # because the overlap is too small) and joining them up anyway would make a mess of the line.
+    pieces.sort(key=lambda piece: piece[0])
+    stitched = list(pieces[0][1].coords)
+    for dist, piece in pieces[1:]:
+        pieceCoords = list(piece.coords)
+        gap = Point(stitched[-1]).distance(Point(pieceCoords[0]))
+        if gap > STITCH_TOLERANCE:
+            raise Exception("Tiled centerline has a {0:.3f}m gap at {1:.1f}m along the thalweg. "
+                            "Try a bigger --tileoverlap".format(gap, dist))
+        # Snap the two ends together
+        stitched[-1] = tuple((np.array(stitched[-1]) + np.array(pieceCoords[0])) / 2)
+        stitched += pieceCoords[1:]
+
+    return LineString(stitched), altLines
+
+
+def _cutLine(thalweg, dist, halfLength, step):
+    """
+    A straight line across the thalweg, square to it at this distance along it
+    :param thalweg: LineString
+    :param dist: Distance along the thalweg
+    :param halfLength: How far the cut line goes out on each side
+    :param step: Distance either side of dist we use to work out the direction of the thalweg
+    :return: (cut, center, tangent) where cut is the LineString, center is where it crosses the thalweg
+             and tangent is the unit direction of the thalweg there
+    """
+    center = np.array(thalweg.interpolate(dist).coords[0])
+    direction = np.array(thalweg.interpolate(dist + step).coords[0]) - np.array(thalweg.interpolate(dist - step).coords[0])
+    tangent = direction / np.hypot(direction[0], direction[1])
+    normal = np.array([-tangent[1], tangent[0]])
+    return LineString([center + normal * halfLength, center - normal * halfLength]), center, tangent
+
+
+def _lineParts(geom):
+    """
+    Whatever comes out of an intersection, give us back a list of LineStrings
+    :param geom:
+    :return:
+    """
+    if geom.type == "LineString":
+        return [geom] if not geom.is_empty else []
+    elif geom.type in ["MultiLineString", "GeometryCollection"]:
+        return [g for g in geom if g.type == "LineString" and not g.is_empty]
+    return []
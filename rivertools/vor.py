@@ -2,7 +2,8 @@ import numpy as np
 from scipy.spatial.qhull import QhullError
 from scipy.spatial import Voronoi
 from shapely.geometry import *
-from shapely.ops import unary_union, linemerge
+from shapely.ops import linemerge
+from shapely.vectorized import contains
 from logger import Logger
 
 class NARVoronoi:
@@ -14,17 +15,15 @@ class NARVoronoi:
     def __init__(self, points):
         """
         The init method is where all the Voronoi magic happens.
-        :param points:
+        :param points: RiverPoints
         """
         # The centroid is what we're going to use to shift all the coords around
         self.points = points
-        self.centroid = MultiPoint([x.point for x in points]).centroid.coords[0]
+        self.centroid = points.coords.mean(axis=0)
         self.log = Logger('NARVoronoi')
 
-        # Give us a numpy array that is easy to work with then subtract the centroid
-        # centering our object around the origin so that the QHull method works properly
-        adjpoints = np.array(MultiPoint([x.point for x in points]))
-        adjpoints = adjpoints - self.centroid
+        # Subtract the centroid centering our object around the origin so that the QHull method works properly
+        adjpoints = points.coords - self.centroid
 
         try:
             self._vor = Voronoi(adjpoints)
@@ -33,26 +32,27 @@ class NARVoronoi:
         except ValueError as e:
             self.log.error("Invalid array specified", e)
 
-        # bake in region adjacency (I have no idea why it's not in by default)
-        self.region_neighbour = []
-
-        # Find which regions are next to which other regions
-        for idx, reg in enumerate(self._vor.regions):
-            adj = []
-            for idy, reg2 in enumerate(self._vor.regions):
-                # Adjacent if we have two matching vertices (neighbours share a wall)
-                if idx != idy and len(set(reg) - (set(reg) - set(reg2))) >= 2:
-                    adj.append(idy)
-            self.region_neighbour.append(adj)
+        # Region adjacency only gets built if someone asks for it (see getNeighbours)
+        self.region_neighbour_ptr = None
+        self.region_neighbour_idx = None
+        self.region_neighbour_ridge = None
 
         # Transform everything back to where it was (with some minor floating point rounding problems)
         # Note that we will use the following and NOT anything from inside _vor (which is shifted to the origin)
         self.vertices = self._vor.vertices + self.centroid
         self.ridge_points = self._vor.ridge_points
-        self.ridge_vertices = self._vor.ridge_vertices
+        self.ridge_vertices = np.array(self._vor.ridge_vertices, dtype=np.int32).reshape(-1, 2)
         self.regions = self._vor.regions
         self.point_region = self._vor.point_region
 
+        self.point_side = points.side
+        self.point_island = points.island
+
+        # Inverse of point_region: the first point that falls in each region (-1 if there isn't one).
+        # We fill it backwards so that the first point wins when duplicate points share a region
+        self.region_point = np.full(len(self.regions), -1, dtype=np.int32)
+        self.region_point[self.point_region[::-1]] = np.arange(len(points) - 1, -1, -1, dtype=np.int32)
+
     def collectCenterLines(self, rivershape, flipIsland=None):
         """
 
@@ -61,76 +61,108 @@ class NARVoronoi:
         :return: LineString (Valid) or MultiLineString (invalid)
         """
 
-        # The first loop here asigns each polygon to either left or right side of the channel based on the
-        # self.point object we passed in earlier.
-        regions = []
-        for idx, reg in enumerate(self.region_neighbour):
-            # obj will have everything we need to know.
-            obj = {
-                "id": idx,
-                "side": 1,
-                "adjacents": reg
-            }
-            lookupregion = np.where(self._vor.point_region == idx)
-            if len(lookupregion[0]) > 0:
-                ptidx = lookupregion[0][0]
-                point = self.points[int(ptidx)]
-                if flipIsland is not None and point.island == flipIsland:
-                    obj["side"] = point.side * -1
-                else:
-                    obj["side"] = point.side
-            regions.append(obj)
-
-        # The second loop goes over each region's neighbours and if a neighbour has a different side
-        # Then we must be on opposite sides of a centerline and so try and find two points representing a wall between
-        # These regions that we will add to our centerline
-        centerlines = []
-        for region in regions:
-            for nidx in region['adjacents']:
-                neighbour = regions[nidx]
-                if neighbour['side'] != region['side']:
-
-                    # Get the two shared points these two regions should have
-                    # NOTE: set(A) - (set(A) - set(B)) is a great pattern
-                    sharedpts = set(self.regions[region['id']]) - (set(self.regions[region['id']]) - set(self.regions[nidx]))
-
-                    # Add this point to the list if it is unique
-                    if -1 not in sharedpts:
-                        lineseg = []
-                        for e in sharedpts:
-                            lineseg.append(self.vertices[e])
-                        if len(lineseg) == 2:
-                            centerlines.append(LineString(lineseg))
-
-        merged = linemerge(unary_union(centerlines))
+        # Give every region the side of the point that created it. Regions with no point
+        # (Qhull sometimes hands back an empty one) sit on side 1.
+        pointside = self.point_side.copy()
+        if flipIsland is not None:
+            pointside[self.point_island == flipIsland] *= -1
+
+        regionside = np.ones(len(self.regions), dtype=np.int8)
+        hasPoint = self.region_point >= 0
+        regionside[hasPoint] = pointside[self.region_point[hasPoint]]
+
+        # A ridge is part of the centerline if the regions on either side of it are on opposite banks.
+        # -1 is a vertex at infinity which we can't use
+        ridgeside = regionside[self.point_region[self.ridge_points]]
+        straddling = (ridgeside[:, 0] != ridgeside[:, 1]) & np.all(self.ridge_vertices >= 0, axis=1)
+        segments = self.vertices[self.ridge_vertices[straddling]]
+
+        # Out past the ends of the channel the extended thalweg drags a long tail of ridges along with it.
+        # Only the ones that touch the channel matter (the ones that cross the banks are enough for
+        # chopCenterlineEnds to find the ends) so drop the rest before we merge anything
+        inside = contains(rivershape, segments[:, :, 0].ravel(), segments[:, :, 1].ravel()).reshape(-1, 2)
+        merged = linemerge(MultiLineString(list(segments[np.any(inside, axis=1)])))
+
+        # If the line leaves the channel part way down (a thalweg digitized just outside a bank for
+        # instance) we just cut a hole in it. Merge everything instead and let chopCenterlineEnds
+        # deal with the crossing like it always has.
+        if merged.type != "LineString":
+            merged = linemerge(MultiLineString(list(segments)))
 
         # Sometimes what we get back is a ring. This is a tricky case because shapely may not choose the start and
         # endpoint correctly. So we have to cycle through and choose new ones
         if merged.is_closed:
+            coords = np.array(merged.coords)
+
             # Get the index of the farthest point outside the geometry
-            candidates = []
-            for ind, coord in enumerate(merged.coords):
-                if not rivershape.contains(Point(coord)):
-                    candidates.append((ind, rivershape.distance(Point(coord))))
-            candidates.sort(key=lambda tup: tup[1])
-            outsideind = candidates[-1][0]
-
-            # Loop through the points with this transform to move the start/end point
-            newline = []
-            maxl = len(merged.coords)
-            # Add the first point in
-            newline.append(merged.coords[outsideind - 1])
-            # Now add every other point
-            for idx in range(0, maxl):
-                t = idx + outsideind
-                if t >= maxl:
-                    t = t - maxl
-                newline.append(merged.coords[t])
-
-            merged = LineString(newline)
+            candidates = np.flatnonzero(~contains(rivershape, coords[:, 0], coords[:, 1]))
+            rings = [rivershape.exterior] + list(rivershape.interiors)
+            dists = np.min([_distanceToLine(coords[candidates], np.array(ring.coords)) for ring in rings], axis=0)
+            # If there's a tie the last one wins
+            outsideind = candidates[len(dists) - 1 - np.argmax(dists[::-1])]
+
+            # Move the start/end point: the point before outsideind first then everything from outsideind
+            # on (wrapping around the end)
+            maxl = len(coords)
+            order = (np.arange(maxl) + outsideind) % maxl
+            merged = LineString(np.vstack((coords[outsideind - 1], coords[order])))
 
         return merged
 
+    def collectAlternateLines(self):
+        """
+        Find the side-channel line around every island from a single pass over the ridges.
+
+        Flipping an island only changes the ridges that have that island on exactly one side of them.
+        The ones that did not straddle the banks before are precisely the bit of alternate line that
+        differs from the main centerline, so we label those ridges by island and merge each group.
+        :return: dict of {island index: LineString (Valid) or MultiLineString (invalid)}
+        """
+        regionside = np.ones(len(self.regions), dtype=np.int8)
+        regionisland = np.full(len(self.regions), -1, dtype=np.int32)
+        hasPoint = self.region_point >= 0
+        regionside[hasPoint] = self.point_side[self.region_point[hasPoint]]
+        regionisland[hasPoint] = self.point_island[self.region_point[hasPoint]]
+
+        ridgeregions = self.point_region[self.ridge_points]
+        ridgeside = regionside[ridgeregions]
+        ridgeisland = regionisland[ridgeregions]
+
+        candidates = np.where(
+            (ridgeside[:, 0] == ridgeside[:, 1]) &
+            (ridgeisland[:, 0] != ridgeisland[:, 1]) &
+            np.all(self.ridge_vertices >= 0, axis=1))[0]
+
+        # A ridge between two islands belongs to both of them
+        labels = np.concatenate((ridgeisland[candidates, 0], ridgeisland[candidates, 1]))
+        ridges = np.concatenate((candidates, candidates))
+        ridges = ridges[labels >= 0]
+        labels = labels[labels >= 0]
+
+        order = np.argsort(labels, kind='mergesort')
+        labels = labels[order]
+        ridges = ridges[order]
+        bounds = np.flatnonzero(np.diff(labels)) + 1
+
+        altlines = {}
+        for islLabels, islRidges in zip(np.split(labels, bounds), np.split(ridges, bounds)):
+            if len(islRidges) == 0:
+                continue
+            segments = self.vertices[self.ridge_vertices[islRidges]]
+            altlines[int(islLabels[0])] = linemerge(MultiLineString(list(segments)))
+
+        return altlines
+
+    def getNeighbours(self, regionIdx):
+        """
+        Look up the regions adjacent to a region from the CSR adjacency arrays
+        :param regionIdx: index into self.regions
+        :return: numpy array of neighbouring region indices
+        """
+        if self.region_neighbour_ptr is None:
+            self._buildAdjacency()
+        return self.region_neighbour_idx[self.region_neighbour_ptr[regionIdx]:self.region_neighbour_ptr[regionIdx + 1]]
+
     def createshapes(self):
         """
         Simple helper function to make polygons out of the untransformed (i.e. original) Voronoi vertices.
@@ -145,3 +177,49 @@ class NARVoronoi:
                     polys.append(Polygon(regionVerts))
         self.polys = MultiPolygon(polys)
 
+    def _buildAdjacency(self):
+        """
+        Bake in region adjacency (I have no idea why it's not in by default). Nothing on the centerline
+        path needs it so we only do this the first time getNeighbours gets called.
+        :return:
+        """
+        # Every Voronoi ridge separates exactly two input points so the ridges already tell us which
+        # regions share a wall. We store the adjacency CSR-style: the neighbours of region i are
+        # region_neighbour_idx[region_neighbour_ptr[i]:region_neighbour_ptr[i+1]] and the ridge between
+        # them is at the same position in region_neighbour_ridge
+        ridgeregions = self._vor.point_region[self._vor.ridge_points]
+        nridges = len(ridgeregions)
+        src = np.concatenate((ridgeregions[:, 0], ridgeregions[:, 1]))
+        dst = np.concatenate((ridgeregions[:, 1], ridgeregions[:, 0]))
+        ridgeids = np.concatenate((np.arange(nridges), np.arange(nridges)))
+
+        order = np.argsort(src, kind='mergesort')
+        counts = np.bincount(src, minlength=len(self._vor.regions))
+        self.region_neighbour_ptr = np.zeros(len(counts) + 1, dtype=np.int32)
+        np.cumsum(counts, out=self.region_neighbour_ptr[1:])
+        self.region_neighbour_idx = dst[order].astype(np.int32)
+        self.region_neighbour_ridge = ridgeids[order].astype(np.int32)
+
+
+def _distanceToLine(points, coords, chunksize=1000000):
+    """
+    Distance from a bunch of points to a line (or ring) given as a coordinate array
+    :param points: (N, 2) array
+    :param coords: (M, 2) array of line vertices
+    :param chunksize: Roughly how many point/segment pairs to work on at a time
+    :return: (N,) array of distances
+    """
+    starts = coords[:-1]
+    deltas = np.diff(coords, axis=0)
+    seglen2 = np.sum(deltas ** 2, axis=1)
+    seglen2[seglen2 == 0] = 1
+
+    dists = np.empty(len(points))
+    step = max(1, chunksize // max(1, len(starts)))
+    for first in range(0, len(points), step):
+        pts = points[first:first + step, np.newaxis, :]
+        # Project each point onto each segment and clamp to the ends
+        t = np.clip(np.sum((pts - starts) * deltas, axis=2) / seglen2, 0, 1)
+        nearest = starts + t[:, :, np.newaxis] * deltas
+        dists[first:first + step] = np.sqrt(np.min(np.sum((pts - nearest) ** 2, axis=2), axis=1))
+    return dists
@@ -2,6 +2,7 @@
 import unittest
 import numpy as np
 import math
+import itertools
 
 from shapely.geometry import *
 
@@ -16,6 +17,175 @@ class TestRasterClass(unittest.TestCase):
         # Visually inspecting points in the raster
         self.assertTrue(True)
 
+    def test_getPixelVals(self):
+        from rivertools.raster import Raster
+
+        class GridRaster(Raster):
+            # Skip GDAL and just make a small grid
+            def __init__(self):
+                self.left = 10.0
+                self.top = 20.0
+                self.cellWidth = 1.0
+                self.cellHeight = -1.0
+                self.rows = 3
+                self.cols = 4
+                self.nodata = -9999.0
+                arr = np.arange(12, dtype=np.float32).reshape(3, 4)
+                arr[2, 3] = self.nodata
+                self.array = np.ma.array(arr, mask=(arr == self.nodata))
+
+        raster = GridRaster()
+        coords = np.array([(10.5, 19.5), (13.9, 18.1), (12.2, 18.5), (13.5, 17.5), (20, 19.5), (11, 10),
+                           (9.5, 19.5), (10.5, 20.5)])
+        values = raster.getPixelVals(coords)
+
+        self.assertEqual(list(values[:3]), [0, 7, 6])
+        # nodata and off the raster (including off the left and top which used to wrap around) are masked
+        self.assertEqual(list(values.mask), [False, False, False, True, True, True, True, True])
+        self.assertTrue(np.isnan(raster.getPixelVal((9.5, 19.5))))
+        self.assertTrue(np.isnan(raster.getPixelVal((10.5, 20.5))))
+
+        # Bilinear: cell centers come back exactly, halfway between them is the average
+        coords = np.array([(10.5, 19.5), (11.0, 19.5), (11.0, 19.0), (10.2, 19.8), (13.5, 17.5), (12.6, 17.6)])
+        values = raster.getPixelVals(coords, method='bilinear')
+        self.assertAlmostEqual(values[0], 0)
+        self.assertAlmostEqual(values[1], 0.5)
+        self.assertAlmostEqual(values[2], (0 + 1 + 4 + 5) / 4.0)
+        # Within half a cell of the edge we use the edge cell
+        self.assertAlmostEqual(values[3], 0)
+        # Anything touching nodata is masked
+        self.assertEqual(list(values.mask), [False, False, False, False, True, True])
+
+        with self.assertRaises(Exception):
+            raster.getPixelVals(coords, method='cubic')
+
+    def test_lazyBlocks(self):
+        import os
+        from collections import OrderedDict
+        from rivertools.raster import Raster
+
+        class BlockRaster(Raster):
+            # Lazy mode without GDAL: blocks come out of an array we already have
+            BLOCK_SIZE = 2
+
+            def __init__(self, arr, cacheBytes):
+                self.left = 0.0
+                self.top = 10.0
+                self.cellWidth = 1.0
+                self.cellHeight = -1.0
+                self.rows, self.cols = arr.shape
+                self.nodata = -9999.0
+                self.lazy = True
+                self.array = None
+                self._full = arr
+                self._pid = os.getpid()
+                self._cache = OrderedDict()
+                self._cacheBytes = 0
+                self._cacheLimit = cacheBytes
+                self._dtype = arr.dtype
+                self.reads = []
+
+            def _readWindow(self, xoff, yoff, xsize, ysize):
+                self.reads.append((xoff, yoff))
+                return self._full[yoff:yoff + ysize, xoff:xoff + xsize].copy()
+
+        arr = np.arange(35, dtype=np.float32).reshape(5, 7)
+        arr[4, 6] = -9999.0
+        # Room for two 2x2 blocks (4 bytes a value and 1 byte a mask cell)
+        raster = BlockRaster(arr, 40)
+
+        values = raster.getPixelVals([(0.5, 9.5), (1.5, 8.5), (6.5, 5.5), (3.5, 9.5)])
+        self.assertEqual(values[0], 0)
+        self.assertEqual(values[1], 8)
+        # The last (partial) block has the nodata cell
+        self.assertTrue(values.mask[2])
+        self.assertEqual(values[3], 3)
+        self.assertEqual(sorted(raster.reads), [(0, 0), (2, 0), (6, 4)])
+
+        # Only two blocks fit so (0, 0) (the least recently used) got thrown away
+        self.assertEqual(len(raster._cache), 2)
+        self.assertEqual(raster.getPixelVal((0.5, 9.5)), 0)
+        self.assertEqual(len(raster.reads), 4)
+
+    def test_memmapCache(self):
+        import os
+        import shutil
+        import tempfile
+        from rivertools.raster import Raster
+        from rivertools.logger import Logger
+
+        class FakeBand:
+            def __init__(self, arr):
+                self.arr = arr
+
+            def ReadAsArray(self, xoff, yoff, xsize, ysize):
+                return self.arr[yoff:yoff + ysize, xoff:xoff + xsize].copy()
+
+        class CacheRaster(Raster):
+            # Everything GDAL would have told us about the source, without GDAL
+            CACHE_PAD = 1
+
+            def __init__(self, filename):
+                self.log = Logger('CacheRaster')
+                self.filename = filename
+                self.gt = (0.0, 1.0, 0.0, 10.0, 0.0, -1.0)
+                self.cols = 10
+                self.rows = 10
+                self.nodata = -9999.0
+                self.bands = 1
+                self.driver = 'GeoTIFF'
+                self.dataType = 6
+                self.proj = ''
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            src = os.path.join(tmpdir, 'dem.tif')
+            with open(src, 'wb') as f:
+                f.write('not really a tif')
+            arr = np.arange(100, dtype=np.float32).reshape(10, 10)
+            arr[5, 5] = -9999.0
+
+            raster = CacheRaster(src)
+            paths = raster._cachePaths(os.path.join(tmpdir, 'cache'))
+            raster._buildCache(paths, FakeBand(arr), (2.5, 4.5, 4.5, 7.5))
+
+            # Clipped to the extent plus a cell of padding
+            self.assertTrue(isinstance(raster.array, np.memmap))
+            self.assertEqual(raster.array.shape, (6, 5))
+            self.assertEqual((raster.left, raster.top), (1.0, 9.0))
+            self.assertEqual((raster.min, raster.max), (11, 65))
+            self.assertEqual(raster.getPixelVal((3.5, 6.5)), 33)
+
+            # A later run maps it straight back in
+            again = CacheRaster(src)
+            self.assertTrue(again._loadCache(paths, (3, 5, 4, 7)))
+            values = again.getPixelVals([(3.5, 6.5), (5.5, 4.5)])
+            self.assertEqual(values[0], 33)
+            self.assertTrue(values.mask[1])
+
+            # Not if it doesn't cover what we need
+            self.assertFalse(again._loadCache(paths, (7.5, 1.5, 8.5, 2.5)))
+
+            # ...or the source has changed
+            with open(src, 'wb') as f:
+                f.write('a different dem')
+            self.assertFalse(again._loadCache(paths, (3, 5, 4, 7)))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_sharedArray(self):
+        from rivertools.raster import sharedArray
+
+        arr = np.arange(12, dtype=np.float32).reshape(3, 4)
+        shared = sharedArray(arr)
+        self.assertTrue(np.array_equal(arr, shared))
+        self.assertEqual(shared.dtype, arr.dtype)
+        self.assertEqual(shared.shape, arr.shape)
+
+        # It's a copy, not a view of the original
+        shared[1, 1] = 99
+        self.assertEqual(arr[1, 1], 5)
+
     def test_isClose(self):
         """
         Oh, also this little helper method:
@@ -49,6 +219,20 @@ class TestShapeHelpers(unittest.TestCase):
 
         self.assertEqual(testShape.bounds, expectedBounds)
 
+    def test_coordsToWKB(self):
+        from shapely import wkb
+        from rivertools.shapes import coordsToWKB
+
+        lines = np.array([[(0, 0), (1, 2.5)], [(-3, 4), (5, -6)]], dtype=float)
+        lineWKB = coordsToWKB(lines)
+        self.assertEqual(len(lineWKB), 2)
+        self.assertEqual(list(wkb.loads(lineWKB[1]).coords), [(-3, 4), (5, -6)])
+        self.assertEqual(lineWKB[0], LineString(lines[0]).wkb)
+
+        pointWKB = coordsToWKB(np.array([(1.5, 2), (3, 4)]))
+        self.assertEqual(wkb.loads(pointWKB[0]), Point(1.5, 2))
+        self.assertEqual(pointWKB[1], Point(3, 4).wkb)
+
     def test_getDiag(self):
         from rivertools.shapes import getDiag
         diag = getDiag(Polygon([(0, 0), (0, 1), (1, 1), (1, 0), (0, 0)]))
@@ -114,6 +298,29 @@ class TestShapeHelpers(unittest.TestCase):
         self.assertEqual(tanpoint.coords[0], (0.5, 0.5))
         self.assertEqual(tanline.length, length*2)
 
+    def test_getStationNormals(self):
+        from rivertools.shapes import getStationNormals, createTangentialLine
+
+        line = LineString([(0, 0), (1, 1), (3, 1), (3, 1), (3, -2)])
+        distances = np.arange(0, line.length, 0.3)
+        points, normals = getStationNormals(line, distances)
+
+        self.assertEqual(points.shape, (len(distances), 2))
+        # Unit normals
+        for normal in normals:
+            self.assertAlmostEqual(np.hypot(*normal), 1, 10)
+
+        # Same answer as the one-at-a-time version (away from the corners where it cuts across)
+        for dist, point, normal in zip(distances, points, normals):
+            tanline, tanpoint = createTangentialLine(dist, line, 1)
+            self.assertAlmostEqual(point[0], tanpoint.coords[0][0], 8)
+            self.assertAlmostEqual(point[1], tanpoint.coords[0][1], 8)
+            coords = [c for c in line.coords]
+            nearCorner = min([Point(c).distance(tanpoint) for c in coords[1:-1]]) < 0.01
+            if not nearCorner:
+                self.assertAlmostEqual(tanline.coords[0][0], point[0] + normal[0], 6)
+                self.assertAlmostEqual(tanline.coords[0][1], point[1] + normal[1], 6)
+
     def test_createTangentialIntersect(self):
         from rivertools.shapes import createTangentialIntersect
         line = LineString([(0, 0), (1, 1)])
@@ -183,17 +390,92 @@ class TestShapeHelpers(unittest.TestCase):
         self.assertEqual(bisectLineSearch(0.0, line), 0)
         self.assertEqual(bisectLineSearch(100.0, line), 99)
 
+    def test_getRiverPoints(self):
+        from rivertools.shapes import getRiverPoints
+
+        shape = Polygon([(0, 0), (0, 4), (10, 4), (10, 0), (0, 0)],
+                        [[(4, 1), (6, 1), (6, 3), (4, 3), (4, 1)]])
+        # Everything above y=2 is the first bank
+        bank = Polygon([(-1, 2), (-1, 5), (11, 5), (11, 2), (-1, 2)])
+        points = getRiverPoints(shape, bank)
+
+        self.assertEqual(len(points), 10)
+        self.assertEqual(list(points.island), [-1] * 5 + [0] * 5)
+        self.assertEqual(list(points.interior), [False] * 5 + [True] * 5)
+        for coord, side in zip(points.coords, points.side):
+            self.assertEqual(side, 1 if coord[1] > 2 else -1)
+
+    def test_getCorridorPoints(self):
+        from rivertools.shapes import getCorridorPoints, RiverPoints
+
+        # Straight channel 20m wide and 200m long with a point way out at the back of a bay
+        coarseLine = LineString([(0, 10), (200, 10)])
+        coarse = RiverPoints([(x, y) for x in np.arange(0, 201, 2.0) for y in [0, 20]] + [(100, 60)])
+        fine = RiverPoints([(x, y) for x in np.round(np.arange(0, 200.05, 0.1), 1) for y in [0, 20]] + [(100, 60.05)])
+
+        points = getCorridorPoints(coarse, fine, [coarseLine], 2.0, 0.25)
+        kept = set(map(tuple, points.coords))
+
+        # The banks are straight and parallel so the coarse points are plenty along most of the reach
+        self.assertLess(len(points), len(fine) / 4)
+        self.assertFalse((100.1, 0) in kept)
+        self.assertTrue((100, 0) in kept)
+        # The ends of the line are where it forks out to the corners so they stay fine
+        self.assertTrue((0.1, 0) in kept)
+        self.assertTrue((199.9, 20) in kept)
+        # The back of the bay is too far away to matter so it stays coarse
+        self.assertFalse(tuple(fine.coords[-1]) in kept)
+        self.assertTrue(tuple(coarse.coords[-1]) in kept)
+        # Every spot is covered exactly once
+        self.assertEqual(len(kept), len(points))
+
+        # Put a sharp bend in the middle and the fine points come back around it
+        bentLine = LineString([(0, 10), (100, 10), (100, 110)])
+        points = getCorridorPoints(coarse, fine, [bentLine], 2.0, 0.25)
+        kept = set(map(tuple, points.coords))
+        self.assertTrue((100.1, 0) in kept)
+        self.assertFalse((50.1, 0) in kept)
+
     def test_densifyShape(self):
         from rivertools.shapes import densifyShape
-        self.assertTrue(False)
+
+        # A 10x10 square with a 2x2 island in the middle
+        shape = Polygon([(0, 0), (0, 10), (10, 10), (10, 0), (0, 0)],
+                        [[(4, 4), (6, 4), (6, 6), (4, 6), (4, 4)]])
+        dense = densifyShape(shape, 0.5)
+
+        # 20 points on each side of the exterior, 4 on each side of the island plus the closing points
+        self.assertEqual(len(dense.exterior.coords), 81)
+        self.assertEqual(len(dense.interiors), 1)
+        self.assertEqual(len(dense.interiors[0].coords), 17)
+
+        # Densifying doesn't move the shape at all
+        self.assertAlmostEqual(dense.area, shape.area, 10)
+        self.assertAlmostEqual(dense.symmetric_difference(shape).area, 0, 10)
 
     def test_densifyRing(self):
         from rivertools.shapes import _densifyRing
-        self.assertTrue(False)
+
+        ring = LinearRing([(0, 0), (0, 1), (1, 1), (1, 0), (0, 0)])
+        dense = _densifyRing(ring, 0.25)
+        self.assertEqual(len(dense.exterior.coords), 17)
+        self.assertEqual(dense.exterior.coords[1], (0, 0.25))
+        self.assertAlmostEqual(dense.area, 1, 10)
 
     def test_densifySegment(self):
         from rivertools.shapes import _densifySegment
-        self.assertTrue(False)
+
+        # Even spacing: we get the start point and everything in between but not the end
+        pts = _densifySegment(LineString([(0, 0), (1, 0)]), 0.25)
+        self.assertEqual(pts, [(0, 0), (0.25, 0), (0.5, 0), (0.75, 0)])
+
+        # Uneven spacing
+        pts = _densifySegment(LineString([(0, 0), (0, 1)]), 0.4)
+        self.assertEqual(len(pts), 3)
+        self.assertAlmostEqual(pts[2][1], 0.8, 10)
+
+        # A segment shorter than the spacing is just its start point
+        self.assertEqual(_densifySegment(LineString([(0, 0), (0.1, 0)]), 0.5), [(0, 0)])
 
 
 class TestMetricClass(unittest.TestCase):
@@ -214,6 +496,42 @@ class TestMetricClass(unittest.TestCase):
         points = interpolateRasterAlongLine(xs, 0.19999)
         self.assertEqual(len(points), 7)
 
+    def test_interpolateStations(self):
+        from rivertools.metrics import interpolateStations, interpolateRasterAlongLine
+
+        endpoints = np.array([[(0, 0), (1, 0)], [(3, 4), (-2, 7.5)], [(0, 0), (0.1, 0.1)]])
+        for interval in [0.2, 0.2001, 0.19999, 0.5]:
+            coords, offsets = interpolateStations(endpoints, interval)
+            self.assertEqual(len(offsets), 4)
+            # Same stations as doing it one at a time
+            for idx, ends in enumerate(endpoints):
+                points = interpolateRasterAlongLine(LineString(ends), interval)
+                xscoords = coords[offsets[idx]:offsets[idx + 1]]
+                self.assertEqual(len(points), len(xscoords))
+                for pt, coord in zip(points, xscoords):
+                    self.assertAlmostEqual(pt.x, coord[0], 10)
+                    self.assertAlmostEqual(pt.y, coord[1], 10)
+
+    def test_interpolateStationsZeroLength(self):
+        import warnings
+        from rivertools.metrics import interpolateStations, calcMetrics
+
+        # A zero length cross section gets one station right on its endpoint and no 0/0 along the way
+        endpoints = np.array([[(0, 0), (4, 0)], [(2, 2), (2, 2)]], dtype=np.float64)
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            coords, offsets = interpolateStations(endpoints, 1.0)
+        self.assertEqual(list(offsets), [0, 5, 6])
+        self.assertEqual(list(coords[5]), [2, 2])
+
+        # ...and nothing downstream of it comes out nan
+        stations = {"points": coords, "values": np.ma.masked_invalid([5.0, 3, 1, 3, 5, 2]), "offsets": offsets}
+        metrics, valid = calcMetrics(endpoints, stations, Polygon([(-1, -1), (5, -1), (5, 6), (-1, 6)]))
+        for name, values in metrics.iteritems():
+            self.assertTrue(np.all(np.isfinite(values)), name)
+        self.assertEqual(metrics['BFArea'][1], 0)
+        self.assertEqual(metrics['XSLength'][1], 0)
+
     def test_lookupRasterValues(self):
         # This is a copout but we test this manually by turning on --points and verifying the raster values
         # are still good
@@ -237,6 +555,70 @@ class TestMetricClass(unittest.TestCase):
         fValue = dryWidth(aLine, aPolyWithDonut)
         self.assertEqual(fValue, 3)
 
+    def test_calcMetrics(self):
+        from rivertools.metrics import calcMetrics, METRICS
+
+        endpoints = np.array([[(0, 0), (4, 0)], [(0, 5), (2, 5)]], dtype=np.float64)
+        stations = {
+            "points": np.array([(0, 0), (1, 0), (2, 0), (3, 0), (4, 0), (0, 5), (1, 5), (2, 5)], dtype=np.float64),
+            "values": np.ma.masked_invalid([5, 3, 1, 3, 5, np.nan, 3, 2]),
+            "offsets": np.array([0, 5, 8])
+        }
+        rivershape = Polygon([(-1, -1), (5, -1), (5, 6), (-1, 6)])
+
+        # Asking out of order still gives METRICS order
+        metrics, valid = calcMetrics(endpoints, stations, rivershape, ['NumStat', 'MaxDepth'])
+        self.assertEqual(metrics.keys(), ['MaxDepth', 'NumStat'])
+        self.assertEqual(list(metrics['MaxDepth']), [4.0, 0.0])
+        self.assertEqual(list(metrics['NumStat']), [5.0, 3.0])
+        # The second one has no reference elevation
+        self.assertEqual(list(valid), [True, False])
+
+        metrics, valid = calcMetrics(endpoints, stations, rivershape)
+        self.assertEqual(metrics.keys(), METRICS.keys())
+        self.assertEqual(metrics['MeanDepth'][0], 8 / 3.0)
+        self.assertEqual(metrics['W2MxDepth'][0], 1.0)
+
+        with self.assertRaises(Exception):
+            calcMetrics(endpoints, stations, rivershape, ['Bogus'])
+
+    def test_metricInputs(self):
+        from rivertools.metrics import metricInputs
+
+        # Depths don't need the boundary at all but anything to do with widths does
+        self.assertFalse('caster' in metricInputs(['MaxDepth', 'BFArea']))
+        self.assertTrue(set(['elevations', 'offsets', 'depths']) <= metricInputs(['MaxDepth']))
+        self.assertTrue(set(['caster', 'rivershape', 'wetWidth']) <= metricInputs(['W2MxDepth']))
+        self.assertTrue('caster' in metricInputs())
+
+    def test_hydraulicMetrics(self):
+        from rivertools.metrics import hydraulicMetrics, MetricBatch
+
+        # A V, a hump that stays dry, one that comes out of the water part way along and one with no BFElev
+        coords = np.array([(0, 0), (1, 0), (2, 0), (3, 0), (4, 0),
+                           (0, 5), (1, 5), (2, 5),
+                           (0, 10), (2, 10), (4, 10),
+                           (0, 15), (1, 15)], dtype=np.float64)
+        values = np.ma.masked_invalid([5.0, 3, 1, 3, 5,
+                                       2, 3, 2,
+                                       4, 2, 6,
+                                       np.nan, 3])
+        offsets = np.array([0, 5, 8, 11, 13])
+
+        # Same refElev and depths every other metric gets
+        batch = MetricBatch(None, {"points": coords, "values": values, "offsets": offsets}, None)
+        metrics = hydraulicMetrics(coords, batch.get('refElev'), batch.get('depths'), offsets)
+
+        self.assertEqual(list(metrics['NumStat']), [5, 3, 3, 2])
+        self.assertAlmostEqual(metrics['BFArea'][0], 8)
+        self.assertAlmostEqual(metrics['WetPerim'][0], 4 * np.sqrt(5))
+        self.assertAlmostEqual(metrics['HRadius'][0], 8 / (4 * np.sqrt(5)))
+        self.assertEqual((metrics['BFArea'][1], metrics['WetPerim'][1], metrics['HRadius'][1]), (0, 0, 0))
+        # Only the first 3/4 of the second stretch is under water
+        self.assertAlmostEqual(metrics['BFArea'][2], 4 + 2.25)
+        self.assertAlmostEqual(metrics['WetPerim'][2], np.sqrt(8) + 0.75 * np.sqrt(20))
+        self.assertEqual((metrics['BFArea'][3], metrics['WetPerim'][3], metrics['HRadius'][3]), (0, 0, 0))
+
     def test_meanDepth(self):
         from rivertools.metrics import meanDepth
 
@@ -296,16 +678,406 @@ class TestMetricClass(unittest.TestCase):
 
 class TestVoronoiClass(unittest.TestCase):
 
+    def test_regionAdjacency(self):
+        from rivertools.vor import NARVoronoi
+        from rivertools.shapes import RiverPoints
+
+        # A 3x3 grid: the middle point's region is a square with exactly 4 walls
+        points = RiverPoints([(x, y) for x in range(3) for y in range(3)])
+        vor = NARVoronoi(points)
+        # Nothing gets built until we ask
+        self.assertIsNone(vor.region_neighbour_ptr)
+
+        midregion = vor.point_region[4]
+        neighbours = sorted(vor.getNeighbours(midregion))
+        expected = sorted(vor.point_region[[1, 3, 5, 7]])
+        self.assertEqual(neighbours, expected)
+
+        # Adjacency has to be symmetric
+        for reg in range(len(vor.regions)):
+            for nreg in vor.getNeighbours(reg):
+                self.assertTrue(reg in vor.getNeighbours(nreg))
+
     def test_collectCenterLines(self):
         from rivertools.vor import NARVoronoi
-        # TODO: Implement TEST
-        self.assertTrue(False)
+        from rivertools.shapes import RiverPoints
+
+        # Two straight banks 2m apart. The centerline has to run right down the middle
+        xs = np.arange(0, 10.5, 0.5)
+        points = RiverPoints([(x, 2.0) for x in xs] + [(x, 0.0) for x in xs],
+                             side=[1] * len(xs) + [-1] * len(xs))
+        vor = NARVoronoi(points)
+        rivershape = Polygon([(0, 0), (0, 2), (10, 2), (10, 0), (0, 0)])
+
+        centerline = vor.collectCenterLines(rivershape)
+        self.assertEqual(centerline.type, "LineString")
+        for coord in centerline.coords:
+            self.assertAlmostEqual(coord[1], 1.0, 6)
+        # The outermost walls run off to infinity so the line stops half a spacing short of each end
+        self.assertAlmostEqual(centerline.length, 9.5, 6)
+
+        # A bite out of the bottom bank that reaches right over the middle. The line leaves the
+        # channel and comes back but it still has to come out in one piece.
+        bitten = Polygon([(0, 0), (0, 2), (10, 2), (10, 0), (6, 0), (6, 1.5), (4, 1.5), (4, 0), (0, 0)])
+        centerline = vor.collectCenterLines(bitten)
+        self.assertEqual(centerline.type, "LineString")
+        self.assertAlmostEqual(centerline.length, 9.5, 6)
+
+    def test_collectAlternateLines(self):
+        from rivertools.vor import NARVoronoi
+        from rivertools.shapes import RiverPoints
+
+        # Two banks 8m apart with a round island sitting above the main line
+        xs = np.arange(0, 10.25, 0.25)
+        banks = RiverPoints([(x, 8.0) for x in xs] + [(x, 0.0) for x in xs],
+                            side=[1] * len(xs) + [-1] * len(xs))
+        islandCoords = Point(5, 5).buffer(1.0).exterior.coords
+        island = RiverPoints(islandCoords, side=[1] * len(islandCoords), interior=[True] * len(islandCoords),
+                             island=[0] * len(islandCoords))
+        vor = NARVoronoi(RiverPoints.concatenate([banks, island]))
+        rivershape = Polygon([(0, 0), (0, 8), (10, 8), (10, 0), (0, 0)])
+
+        altLines = vor.collectAlternateLines()
+        self.assertEqual(list(altLines.keys()), [0])
+        self.assertEqual(altLines[0].type, "LineString")
+
+        # The side channel goes over the top of the island
+        self.assertTrue(altLines[0].intersects(LineString([(5, 6), (5, 8)])))
+
+        # It should be exactly the bit of the flipped centerline that isn't on the main line
+        flipped = vor.collectCenterLines(rivershape, flipIsland=0)
+        main = vor.collectCenterLines(rivershape)
+        self.assertAlmostEqual(altLines[0].length, flipped.difference(main).length, 6)
 
     def test_createshapes(self):
         from rivertools.vor import NARVoronoi
         # TODO: Implement TEST
         self.assertTrue(False)
 
+class TestCenterline(unittest.TestCase):
+
+    def test_calcAlternateLines(self):
+        import rivertools.centerline as centerline
+        from rivertools.shapes import densifyShape, getRiverPoints
+        from rivertools.vor import NARVoronoi
+
+        # A straight reach with three islands down the middle
+        river = Polygon([(0, 0), (100, 0), (100, 20), (0, 20)]).difference(
+            MultiPolygon([Point(x, y).buffer(2.5) for x, y in [(25, 14), (50, 6), (75, 14)]]))
+        points = getRiverPoints(densifyShape(river, 0.5), Polygon([(-10, 10), (110, 10), (110, 30), (-10, 30)]))
+        vor = NARVoronoi(points)
+        boundary = Polygon(river.exterior)
+
+        for smoothing in [0, 5]:
+            centerline._ALTLINE_STATE.clear()
+            centerline._ALTLINE_STATE.update({
+                'vor': vor,
+                'diffLines': None,
+                'centerlineSmooth': vor.collectCenterLines(boundary),
+                'boundary': boundary,
+                'smoothing': smoothing
+            })
+            try:
+                serial = centerline.calcAlternateLines(range(3))
+                pooled = centerline.calcAlternateLines(range(3), workers=3)
+            finally:
+                centerline._ALTLINE_STATE.clear()
+
+            # Same lines in the same order no matter how many workers
+            self.assertEqual(len(serial), 3)
+            self.assertTrue(all([line is not None for line in serial]))
+            self.assertEqual([line.wkb for line in pooled], [line.wkb for line in serial])
+
+
+class TestMedialAxisRaster(unittest.TestCase):
+
+    def test_centerline(self):
+        from rivertools.medialaxis import MedialAxisRaster
+
+        # A 4m wide straight channel. The medial axis is y=2
+        rivershape = Polygon([(0, 0), (0, 4), (20, 4), (20, 0), (0, 0)])
+        medialAxis = MedialAxisRaster(rivershape, 0.25)
+
+        # Cells down the middle are the furthest from the banks
+        self.assertAlmostEqual(medialAxis.distance.max(), 2.0, 1)
+
+        centerline = medialAxis.centerline((1, 1), (19, 3))
+        self.assertEqual(centerline.type, "LineString")
+        # Away from the ends the line sits on the axis to within a cell
+        for coord in centerline.coords:
+            if 3 < coord[0] < 17:
+                self.assertTrue(abs(coord[1] - 2.0) <= 0.25)
+
+
+class TestTiling(unittest.TestCase):
+
+    def test_getTileWindows(self):
+        from rivertools.tiling import getTileWindows
+
+        windows = getTileWindows(250, 100, 10)
+        self.assertEqual(windows, [(0, 110, 0, 100), (90, 210, 100, 200), (190, 250, 200, 250)])
+
+        # Shorter than one tile is just one tile
+        self.assertEqual(getTileWindows(50, 100, 10), [(0, 50, 0, 50)])
+
+    def test_lineSubstring(self):
+        from rivertools.tiling import lineSubstring
+
+        line = LineString([(0, 0), (10, 0), (10, 10)])
+        sub = lineSubstring(line, 5, 15)
+        self.assertEqual(list(sub.coords), [(5, 0), (10, 0), (10, 5)])
+        self.assertAlmostEqual(sub.length, 10, 10)
+
+        # Substrings that land inside a single segment
+        sub = lineSubstring(line, 1, 2)
+        self.assertEqual(list(sub.coords), [(1, 0), (2, 0)])
+
+    def test_tiledCenterline(self):
+        from rivertools.tiling import tiledCenterline
+        from rivertools.shapes import densifyShape, getRiverPoints
+        from rivertools.vor import NARVoronoi
+
+        # A meandering reach 20m wide with a big round bay and an island, and a thalweg down the
+        # middle that runs out past both ends
+        xs = np.linspace(0, 300, 301)
+        mid = 15 * np.sin(xs / 30.0)
+        river = Polygon(list(zip(xs, mid + 10)) + list(zip(xs[::-1], mid[::-1] - 10)))
+        river = river.union(Point(200, 15 * np.sin(200 / 30.0) + 20).buffer(25))
+        river = river.difference(Point(100, 15 * np.sin(100 / 30.0)).buffer(3))
+        thalweg = LineString([(-20, mid[0])] + list(zip(xs, mid)) + [(320, mid[-1])])
+        leftBank = Polygon(list(thalweg.coords) + [(320, 100), (-20, 100)])
+        points = getRiverPoints(densifyShape(river, 0.5), leftBank)
+
+        vor = NARVoronoi(points)
+        boundary = Polygon(river.exterior)
+        centerline = vor.collectCenterLines(boundary)
+        altLines = vor.collectAlternateLines()
+
+        # Small tiles so the bay and the island both land across tile edges
+        tiledLine, tiledAlts = tiledCenterline(points, thalweg, river, 40, 15)
+        self.assertEqual(tiledLine.type, "LineString")
+        self.assertLess(tiledLine.intersection(boundary).hausdorff_distance(centerline.intersection(boundary)), 1e-6)
+        self.assertEqual(list(altLines.keys()), [0])
+        self.assertEqual(list(tiledAlts.keys()), [0])
+        for idx in altLines:
+            self.assertLess(tiledAlts[idx].hausdorff_distance(altLines[idx]), 1e-6)
+
+
+class TestRayCaster(unittest.TestCase):
+
+    def test_castCrossSections(self):
+        from rivertools.rays import RayCaster
+        from rivertools.shapes import createNormalIntersect, getDiag
+
+        # A river with an island in it
+        river = Polygon([(0, 0), (100, 0), (100, 20), (0, 20)]).difference(Point(50, 10).buffer(4))
+        centerline = LineString([(0, 3), (100, 3)])
+        stations = np.array([[10, 3], [50, 3], [50.0, 15.0], [120, 3], [0, 3]])
+        normals = np.array([[0, -1], [0, -1], [0.6, -0.8], [0, -1], [0, -1]])
+
+        xslines = RayCaster(river).castCrossSections(stations, normals)
+
+        self.assertEqual(list(xslines[0].coords), [(10, 0), (10, 20)])
+        # Stops at the island
+        self.assertEqual(list(xslines[1].coords[0]), [50, 0])
+        self.assertAlmostEqual(xslines[1].coords[1][1], 6, 1)
+        # Outside the river means no cross section
+        self.assertIsNone(xslines[3])
+
+        # Same answer as the overlay
+        for station, normal, xs in zip(stations, normals, xslines):
+            expected = createNormalIntersect(station, normal, river, getDiag(river))[0]
+            if expected is None:
+                self.assertIsNone(xs)
+            else:
+                self.assertLess(expected.hausdorff_distance(xs), 1e-8)
+
+    def test_castCrossSectionsVertex(self):
+        from rivertools.rays import RayCaster
+        from rivertools.shapes import createNormalIntersect, getDiag
+
+        # Spikes of bank that come down from the top and up from the bottom and just touch y=5
+        river = Polygon([(0, 0), (14, 0), (15, 5), (16, 0), (20, 0), (20, 10), (6, 10), (5, 5), (4, 10), (0, 10)])
+        stations = np.array([[2, 5], [2, 5], [10, 5], [10, 5], [18, 5], [18, 5]], dtype=float)
+        normals = np.array([[1, 0], [-1, 0], [1, 0], [-1, 0], [1, 0], [-1, 0]], dtype=float)
+
+        xslines = RayCaster(river).castCrossSections(stations, normals)
+
+        # The overlay splits the line at both spikes
+        pieces = LineString([(-5, 5), (25, 5)]).intersection(river)
+        self.assertEqual(sorted(piece.bounds for piece in pieces),
+                         [(0, 5, 5, 5), (5, 5, 15, 5), (15, 5, 20, 5)])
+
+        # Grazing a vertex stops the cross section no matter which side the spike is on
+        for station, normal, xs in zip(stations, normals, xslines):
+            self.assertEqual(xs.bounds, [piece for piece in pieces if piece.distance(Point(station)) == 0][0].bounds)
+            expected = createNormalIntersect(station, normal, river, getDiag(river))[0]
+            self.assertLess(expected.hausdorff_distance(xs), 1e-8)
+
+    def test_insideLengths(self):
+        from rivertools.rays import RayCaster
+        from rivertools.metrics import dryWidth
+
+        river = Polygon([(0, 0), (100, 0), (100, 20), (0, 20)],
+                        [[(40, 8), (44, 8), (44, 12), (40, 12)], [(60, 8), (62, 8), (62, 12), (60, 12)]])
+        endpoints = np.array([
+            [(10, 0), (10, 20)],    # Bank to bank
+            [(30, 10), (70, 10)],   # Across both islands
+            [(-10, 5), (10, 5)],    # Starts outside
+            [(-10, -5), (-1, -5)],  # Nowhere near
+            [(41, 9), (43, 11)],    # On the island
+            [(50, 10), (50, 10)]    # Zero length
+        ], dtype=float)
+
+        lengths = RayCaster(river).insideLengths(endpoints, chunksize=2)
+        self.assertEqual(list(lengths), [20, 34, 10, 0, 0, 0])
+
+        # Same as the overlay (which can't cope with missing the river altogether)
+        for ends, length in zip(endpoints[:3], lengths):
+            self.assertAlmostEqual(dryWidth(LineString(ends), river), length)
+
+
+class TestCrossSections(unittest.TestCase):
+
+    def test_layoutCrossSections(self):
+        import rivertools.crosssections as crosssections
+
+        river = Polygon([(0, 0), (100, 0), (100, 20), (0, 20)]).difference(Point(50, 14).buffer(3))
+        centerlines = [
+            {'geometry': LineString([(0, 8), (100, 8)]), 'fields': {'ID': 1, 'Channel': 'Main'}},
+            {'geometry': LineString([(40, 18.5), (60, 18.5)]), 'fields': {'ID': 2, 'Channel': 'Side'}}
+        ]
+
+        layout = crosssections.layoutCrossSections(centerlines, river, 1.0, keepStations=True)
+        self.assertEqual(len(layout['stations']), 120)
+        self.assertEqual(list(layout['endpoints'][10].ravel()), [10, 0, 10, 20])
+        # Only the side channel cross sections that stop at the island get kept
+        sideDistances = layout['distance'][layout['line'] == 1]
+        self.assertTrue(len(sideDistances) > 0)
+        self.assertTrue(np.all(np.abs(sideDistances + 40 - 50) <= 3))
+
+        # Small blocks across a few workers give back exactly the same thing
+        oldBlock = crosssections.LAYOUT_BLOCK
+        crosssections.LAYOUT_BLOCK = 7
+        try:
+            parallel = crosssections.layoutCrossSections(centerlines, river, 1.0, keepStations=True, workers=3)
+        finally:
+            crosssections.LAYOUT_BLOCK = oldBlock
+        for key in ['endpoints', 'line', 'distance', 'stations']:
+            self.assertTrue(np.array_equal(layout[key], parallel[key]))
+
+        # Without the separation points we don't hang onto the stations at all
+        noStations = crosssections.layoutCrossSections(centerlines, river, 1.0)
+        self.assertEqual(noStations['stations'].shape, (0, 2))
+        for key in ['endpoints', 'line', 'distance']:
+            self.assertTrue(np.array_equal(layout[key], noStations[key]))
+
+    def test_crossSectionSet(self):
+        from rivertools.crosssections import CrossSectionSet
+
+        layout = {
+            'endpoints': np.array([[(0, 0), (0, 10)], [(1, 0), (1, 4)], [(5, 0), (5, 3)]], dtype=float),
+            'line': np.array([0, 0, 1]),
+            'distance': np.array([0.0, 1.0, 0.0]),
+            'lineIDs': [7, 8],
+            'lineMain': [True, False]
+        }
+        xsset = CrossSectionSet.fromLayout(layout)
+        self.assertEqual(len(xsset), 3)
+        self.assertEqual(list(xsset.lengths()), [10, 4, 3])
+        self.assertEqual(list(xsset.isMain()), [True, True, False])
+        self.assertEqual(list(xsset.geometry(1).coords), [(1, 0), (1, 4)])
+
+        # A subset shares its columns with the set it came from
+        xsset.metrics['XSLength'] = xsset.lengths()
+        sub = xsset.subset(1, 3)
+        self.assertEqual(list(sub.distance), [1.0, 0.0])
+        self.assertEqual(list(sub.metrics['XSLength']), [4, 3])
+        sub.isValid[:] = True
+        self.assertEqual(list(xsset.isValid), [False, True, True])
+
+    def test_xsOverlapValidate(self):
+        from rivertools.crosssections import xsOverlapValidate
+
+        # Crossing XSs on the same line don't count. Neither do invalid ones.
+        endpoints = np.array([[(x, 0), (x, 10)] for x in range(5)] +
+                             [[(-1, 8), (5, 8)]] +
+                             [[(-1, 5), (0.5, 5)], [(2.5, 2), (3.5, 2)], [(10, 0), (10, 10)]], dtype=float)
+        lines = np.array([0, 0, 0, 0, 0, 0, 1, 1, 1])
+        valid = np.array([True, True, True, True, True, True, True, False, True])
+
+        newValid = xsOverlapValidate(endpoints, lines, valid, chunksize=2)
+        self.assertEqual(list(newValid), [False, True, True, True, True, True, False, False, True])
+
+    def test_xsOverlapValidateSet(self):
+        from rivertools.crosssections import CrossSectionSet, xsOverlapValidate
+
+        rand = np.random.RandomState(7)
+        centers = rand.uniform(0, 50, (40, 2))
+        angles = rand.uniform(0, np.pi, 40)
+        halves = np.column_stack((np.cos(angles), np.sin(angles))) * rand.uniform(0, 6, 40)[:, np.newaxis]
+
+        endpoints = np.concatenate([
+            np.array([
+                [(0, 0), (0, 10)], [(-1, 5), (0.5, 5)],     # Crossing pair
+                [(20, 0), (20, 10)], [(20, 10), (25, 10)],  # Touching end to end
+                [(30, 0), (30, 10)], [(29, 2), (31, 2)],    # Crossing but the second one is invalid
+                [(40, 0), (40, 10)], [(40, 0), (40, 10)]    # On top of each other but on the same line
+            ], dtype=float),
+            np.stack((centers - halves, centers + halves), axis=1)
+        ])
+        layout = {
+            'endpoints': endpoints,
+            'line': np.concatenate(([0, 1, 0, 1, 0, 1, 0, 0], rand.randint(0, 3, 40))),
+            'distance': np.zeros(len(endpoints)),
+            'lineIDs': [1, 2, 3],
+            'lineMain': [True, False, False]
+        }
+        xsset = CrossSectionSet.fromLayout(layout)
+        xsset.isValid[:] = True
+        xsset.isValid[5] = False
+        xsset.isValid[8:] = rand.rand(40) > 0.2
+        before = xsset.isValid.copy()
+
+        xsset.isValid[:] = xsOverlapValidate(xsset.endpoints, xsset.line, xsset.isValid, chunksize=3)
+        self.assertEqual(list(xsset.isValid[:8]), [False, False, False, False, True, False, True, True])
+
+        # Same answer as testing every pair with shapely
+        expected = before.copy()
+        for idxA, idxB in itertools.combinations(range(len(xsset)), 2):
+            if before[idxA] and before[idxB] and xsset.line[idxA] != xsset.line[idxB] \
+                    and xsset.geometry(idxA).intersects(xsset.geometry(idxB)):
+                expected[idxA] = False
+                expected[idxB] = False
+        self.assertEqual(list(xsset.isValid), list(expected))
+
+    def test_xsLengthValidate(self):
+        from rivertools.crosssections import xsLengthValidate
+
+        lengths = np.array([10.0] * 20 + [200.0] + [50.0, 60.0])
+        lines = np.array([0] * 21 + [1, 1])
+        self.assertEqual(list(xsLengthValidate(lengths, lines)), [True] * 20 + [False] + [True, True])
+
+    def test_segmentsIntersect(self):
+        from rivertools.crosssections import segmentsIntersect
+
+        segsA = np.array([[(0, 0), (2, 2)], [(0, 0), (1, 0)], [(0, 0), (1, 0)], [(0, 0), (1, 0)], [(0, 0), (1, 0)]], dtype=float)
+        segsB = np.array([[(0, 2), (2, 0)], [(1, 0), (1, 1)], [(2, 0), (3, 0)], [(0.5, 0), (3, 0)], [(0, 1), (1, 1)]], dtype=float)
+        # Crossing, touching at an end, collinear apart, collinear overlapping, parallel
+        self.assertEqual(list(segmentsIntersect(segsA, segsB)), [True, True, False, True, False])
+
+        # Zero length segments never touch anything, just like in shapely. Not even when they're inside
+        # the other one's box or sitting right on it.
+        segsA = np.array([[(1, 0.2), (1, 0.2)], [(1, 0.5), (1, 0.5)], [(0, 0), (1, 0)], [(0, 0), (1, 0)],
+                          [(3, 3), (3, 3)], [(3, 3), (3, 3)]], dtype=float)
+        segsB = np.array([[(0, 0), (2, 1)], [(0, 0), (2, 1)], [(2, 0), (2, 0)], [(0.5, 0), (0.5, 0)],
+                          [(3, 3), (3, 3)], [(3, 3.5), (3, 3.5)]], dtype=float)
+        self.assertEqual(list(segmentsIntersect(segsA, segsB)), [False] * 6)
+        # Same as shapely
+        for segA, segB, hit in zip(segsA, segsB, segmentsIntersect(segsA, segsB)):
+            self.assertEqual(LineString(segA).intersects(LineString(segB)), hit)
+
+
 class TestGeoSmoothingClass(unittest.TestCase):
     """
     This is going to be a hard one to test but it came from someone else's implementation so